@@ -1,30 +1,130 @@
 """Aplicación principal"""
 
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.openapi.utils import get_openapi
 from app.routers import auth, users, roles, categories, books, loans, loans_histories, books_reservations, fines
+from app.utils.database import create_db_pool, database_unavailable_handler, DATABASE_UNAVAILABLE_ERRORS
+from app.utils.fines import fine_recompute_loop
+from app.middleware.auth import AuthASGIMiddleware, PUBLIC_PATHS
+from app.middleware.timing import TimingASGIMiddleware
+from app.middleware.request_id import RequestIDASGIMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+logger = logging.getLogger("uvicorn.error")
 
-# Configuración de CORS para el consumo de la api
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Crea el pool de conexiones y lanza el recálculo periódico de multas al
+    iniciar la aplicación; al apagarla detiene la tarea y cierra el pool.
+    """
+    # Con uvicorn[standard] el event loop debería ser el de uvloop
+    loop = asyncio.get_running_loop()
+    logger.info("Event loop: %s.%s", type(loop).__module__, type(loop).__name__)
+
+    app.state.pool = await create_db_pool()
+    fines_task = asyncio.create_task(fine_recompute_loop(app.state.pool))
+    yield
+    fines_task.cancel()
+    try:
+        await fines_task
+    except asyncio.CancelledError:
+        pass
+    await app.state.pool.close()
+
+
+# La documentación interactiva (/docs, /redoc y /openapi.json) se puede apagar
+# en producción con ENABLE_DOCS=false
+ENABLE_DOCS = os.getenv("ENABLE_DOCS", "true").lower() == "true"
+
+app = FastAPI(
+    lifespan=lifespan,
+    docs_url="/docs" if ENABLE_DOCS else None,
+    redoc_url="/redoc" if ENABLE_DOCS else None,
+    openapi_url="/openapi.json" if ENABLE_DOCS else None,
+)
+
+# Middlewares de la aplicación. Todos son ASGI puros (una clase por tarea en
+# app/middleware); no se usa BaseHTTPMiddleware, que envuelve cada petición y
+# su cuerpo en objetos extra. El último en registrarse queda más por fuera, así
+# que el orden efectivo es: CORS -> request id -> tiempos -> autenticación.
+# La validación del token JWT va al final para que las respuestas 401 también
+# lleven el identificador, el tiempo y las cabeceras de CORS.
+app.add_middleware(AuthASGIMiddleware)
+app.add_middleware(TimingASGIMiddleware)
+app.add_middleware(RequestIDASGIMiddleware)
+
+# Un error de conexión con la base de datos se responde con 503 desde cualquier endpoint
+for error in DATABASE_UNAVAILABLE_ERRORS:
+    app.add_exception_handler(error, database_unavailable_handler)
+
+# Orígenes autorizados a consumir la api (separados por comas)
+FRONTEND_URLS = os.getenv("FRONTEND_URL", "http://localhost:3000").split(",")
+
+# Configuración de CORS para el consumo de la api. Con orígenes explícitos el
+# navegador respeta max_age y cachea el preflight (OPTIONS) durante 24 horas.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=FRONTEND_URLS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["Authorization", "Content-Type", "X-Request-ID", "If-None-Match"],
+    expose_headers=["X-Request-ID", "X-Process-Time", "ETag"],
+    max_age=86400,
 )
 
-# Rutas de los endpoints
-app.include_router(auth.router,  tags=["Authentication"])
-app.include_router(users.router,  tags=["Users"])
-app.include_router(roles.router, tags=["Roles"])
-app.include_router(categories.router,
-                   tags=["Categories"])
-app.include_router(books.router, tags=["Books"])
-app.include_router(loans.router,  tags=["Loans"])
-app.include_router(loans_histories.router,
-                   tags=["Loan Histories"])
-app.include_router(books_reservations.router,
-                   tags=["Book Reservations"])
-app.include_router(fines.router, tags=["Fines"])
+# Rutas de los endpoints con su etiqueta en la documentación
+ROUTERS = [
+    (auth.router, "Authentication"),
+    (users.router, "Users"),
+    (roles.router, "Roles"),
+    (categories.router, "Categories"),
+    (books.router, "Books"),
+    (loans.router, "Loans"),
+    (loans_histories.router, "Loan Histories"),
+    (books_reservations.router, "Book Reservations"),
+    (fines.router, "Fines"),
+]
+
+for router, tag in ROUTERS:
+    app.include_router(router, tags=[tag])
+
+
+def custom_openapi() -> dict:
+    """
+    Genera el esquema OpenAPI declarando la autenticación Bearer.
+
+    El token lo valida AuthASGIMiddleware y no una dependencia de las rutas, así
+    que FastAPI no sabría qué rutas están protegidas. Aquí se declara el flujo
+    password de OAuth2 (el de /token/) y se marca cada ruta fuera de
+    PUBLIC_PATHS, para que /docs muestre el botón Authorize y envíe el token.
+
+    Returns:
+        dict: El esquema OpenAPI de la aplicación (se genera una sola vez).
+    """
+    if app.openapi_schema:
+        return app.openapi_schema
+
+    schema = get_openapi(title=app.title, version=app.version, routes=app.routes)
+    schema.setdefault("components", {})["securitySchemes"] = {
+        "OAuth2PasswordBearer": {
+            "type": "oauth2",
+            "flows": {"password": {"tokenUrl": "/token/", "scopes": {}}},
+        }
+    }
+    for path, operations in schema["paths"].items():
+        if path.startswith(PUBLIC_PATHS):
+            continue
+        for operation in operations.values():
+            operation["security"] = [{"OAuth2PasswordBearer": []}]
+
+    app.openapi_schema = schema
+    return schema
+
+
+app.openapi = custom_openapi
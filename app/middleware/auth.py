@@ -0,0 +1,77 @@
+"""Middleware de autenticación"""
+from jose import JWTError
+from starlette.responses import JSONResponse
+from app.utils.jwt_cache import verify_cached
+from app.utils.token_blacklist import is_token_invalidated
+
+# Rutas que se pueden consumir sin token
+PUBLIC_PATHS = ("/token", "/register", "/docs", "/redoc", "/openapi.json")
+
+
+class AuthASGIMiddleware:
+    """
+    Middleware ASGI puro que valida el token JWT de cada petición protegida.
+
+    Lee la cabecera Authorization directamente de scope["headers"], sin construir
+    objetos Request/Response. El token se verifica una sola vez por petición y
+    sus claims quedan en request.state.user, además de request.state.user_id
+    (uid), request.state.role_id (rid) y request.state.jti.
+    Si el token falta, es inválido o fue invalidado con /logout/ responde 401
+    sin llegar al router.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Solo se validan peticiones HTTP a rutas protegidas; los preflight de CORS no llevan token
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"].startswith(PUBLIC_PATHS):
+            await self.app(scope, receive, send)
+            return
+
+        token = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, param = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer":
+                    token = param
+                break
+
+        if not token:
+            await self._unauthorized("Not authenticated")(scope, receive, send)
+            return
+
+        try:
+            claims = verify_cached(token)
+        except JWTError:
+            await self._unauthorized("Could not validate credentials")(scope, receive, send)
+            return
+
+        # Todo token emitido por /token/ identifica al usuario con sub
+        if not claims.get("sub"):
+            await self._unauthorized("Could not validate credentials")(scope, receive, send)
+            return
+
+        # Rechazar los tokens que se cerraron con /logout/ antes de despachar la ruta
+        jti = claims.get("jti")
+        if jti and await is_token_invalidated(jti):
+            await self._unauthorized("Token has been invalidated")(scope, receive, send)
+            return
+
+        state = scope.setdefault("state", {})
+        state["user"] = claims
+        state["user_id"] = claims.get("uid")
+        state["role_id"] = claims.get("rid")
+        state["jti"] = jti
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    def _unauthorized(detail: str) -> JSONResponse:
+        """
+        Construye la respuesta 401 con la cabecera que exige el esquema Bearer.
+        """
+        return JSONResponse(
+            status_code=401,
+            content={"detail": detail},
+            headers={"WWW-Authenticate": "Bearer"},
+        )
@@ -0,0 +1,38 @@
+"""Middleware de identificador de petición"""
+from uuid import uuid4
+
+
+class RequestIDASGIMiddleware:
+    """
+    Middleware ASGI puro que asigna un identificador a cada petición HTTP.
+
+    Reutiliza la cabecera X-Request-ID si el cliente la envía o genera una nueva,
+    la deja en request.state.request_id y la devuelve en la respuesta para poder
+    relacionar los registros de una misma petición.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        if not request_id:
+            request_id = uuid4().hex
+
+        scope.setdefault("state", {})["request_id"] = request_id
+        header = (b"x-request-id", request_id.encode("latin-1"))
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [header]
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
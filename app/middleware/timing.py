@@ -0,0 +1,31 @@
+"""Middleware de medición de tiempos"""
+import time
+
+
+class TimingASGIMiddleware:
+    """
+    Middleware ASGI puro que mide cuánto tarda cada petición HTTP.
+
+    Agrega la cabecera X-Process-Time (en milisegundos) a la respuesta, justo
+    cuando se envían las cabeceras, sin envolver el cuerpo de la respuesta.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-process-time", f"{elapsed_ms:.2f}".encode("latin-1"))
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
@@ -1,23 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from app.schemas.books import BookCreate, BookUpdate, BookResponse
-from app.utils.database import get_db_connection
-from fastapi.security import OAuth2PasswordBearer
-from typing import List
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from app.schemas.books import BookCreate, BookUpdate, BookResponse, BookPage
+from app.utils.database import get_conn, acquire_conn, DATABASE_UNAVAILABLE_ERRORS
+from app.utils.availability_cache import get_cached_availability, cache_availability, invalidate_availability
 
 router = APIRouter()
 
-# Esquema para autenticar a los usuarios con token JWT
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-
 
 @router.post("/books/", response_model=BookResponse)
-async def create_book(book: BookCreate, token: str = Depends(oauth2_scheme)):
+async def create_book(book: BookCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Crea un nuevo libro en la base de datos.
 
     Args:
         book (BookCreate): Datos del libro a crear.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles del libro creado.
@@ -25,55 +22,39 @@ async def create_book(book: BookCreate, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si ya existe un libro con el mismo ISBN.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si el libro con el mismo ISBN ya existe
-    cursor.execute("SELECT * FROM books WHERE isbn = %s", (book.isbn,))
-    existing_book = cursor.fetchone()
-
-    if existing_book:
-        raise HTTPException(
-            status_code=400, detail="Book with this ISBN already exists"
-        )
-
     try:
-        # Crear el nuevo libro
+        # Crear el nuevo libro; si el ISBN ya existe no se inserta nada
         query = """
             INSERT INTO books (title, author, category_id, isbn, copies_available)
-            VALUES (%s, %s, %s, %s, %s)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (isbn) DO NOTHING
             RETURNING id, title, author, category_id, isbn, copies_available, created_at, updated_at
         """
-        cursor.execute(query, (book.title, book.author,
-                               book.category_id, book.isbn, book.copies_available))
-        conn.commit()
-
-        new_book = cursor.fetchone()
+        new_book = await conn.fetchrow(query, book.title, book.author,
+                                       book.category_id, book.isbn, book.copies_available)
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error creating book: {str(e)}")
 
-    return {
-        "id": new_book["id"],
-        "title": new_book["title"],
-        "author": new_book["author"],
-        "category_id": new_book["category_id"],
-        "isbn": new_book["isbn"],
-        "copies_available": new_book["copies_available"],
-        "created_at": new_book["created_at"],
-        "updated_at": new_book["updated_at"],
-        "message": "Book created successfully"
-    }
+    if new_book is None:
+        raise HTTPException(
+            status_code=400, detail="Book with this ISBN already exists"
+        )
+
+    return dict(new_book)
 
 
 @router.get("/books/{book_id}/", response_model=BookResponse)
-async def get_book(book_id: int, token: str = Depends(oauth2_scheme)):
+async def get_book(book_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Obtiene los detalles de un libro basado en su ID.
 
     Args:
         book_id (int): El ID del libro a obtener.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles del libro.
@@ -81,76 +62,64 @@ async def get_book(book_id: int, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si el libro no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Obtener el libro por su ID
-    cursor.execute("SELECT * FROM books WHERE id = %s", (book_id,))
-    book = cursor.fetchone()
+    book = await conn.fetchrow("""
+        SELECT id, title, author, category_id, isbn, copies_available, created_at, updated_at
+        FROM books WHERE id = $1
+    """, book_id)
 
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
 
-    return {
-        "id": book["id"],
-        "title": book["title"],
-        "author": book["author"],
-        "category_id": book["category_id"],
-        "isbn": book["isbn"],
-        "copies_available": book["copies_available"],
-        "created_at": book["created_at"],
-        "updated_at": book["updated_at"],
-        "message": "Book retrieved successfully"
-    }
+    # Las columnas coinciden con BookResponse; el registro se entrega tal cual
+    return dict(book)
 
 
-@router.get("/books/", response_model=List[BookResponse])
-async def get_all_books(page: int = Query(1, ge=1), per_page: int = Query(10, ge=1, le=100), token: str = Depends(oauth2_scheme)):
+@router.get("/books/", response_model=BookPage)
+async def get_all_books(after_id: int = Query(0, ge=0), per_page: int = Query(10, ge=1, le=100), include_total: bool = Query(False), conn: asyncpg.Connection = Depends(get_conn)):
     """
-    Obtiene todos los libros de la base de datos con paginación.
+    Obtiene los libros de la base de datos con paginación por cursor (keyset).
+
+    En lugar de saltar filas con OFFSET se continúa a partir del último ID
+    recibido, por lo que el costo de cada página no crece con su posición.
 
     Args:
-        page (int): Número de página (por defecto 1).
+        after_id (int): ID del último libro de la página anterior (0 para la primera página).
         per_page (int): Número de libros por página (por defecto 10, máximo 100).
-        token (str): El token JWT del usuario autenticado.
+        include_total (bool): Si es True también se devuelve el total de libros (total).
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
-        list: Una lista de libros.
+        dict: Los libros de la página y el cursor de la siguiente (next_cursor).
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    offset = (page - 1) * per_page
+    # Obtener la página de libros a partir del cursor (recorre el índice de la llave primaria)
+    books = await conn.fetch("""
+        SELECT id, title, author, category_id, isbn, copies_available, created_at, updated_at
+        FROM books WHERE id > $1 ORDER BY id LIMIT $2
+    """, after_id, per_page)
 
-    # Obtener todos los libros con paginación
-    cursor.execute("SELECT * FROM books LIMIT %s OFFSET %s",
-                   (per_page, offset))
-    books = cursor.fetchall()
+    # Si la página está completa puede haber más libros después del último ID
+    next_cursor = books[-1]["id"] if len(books) == per_page else None
 
-    if not books:
-        raise HTTPException(status_code=404, detail="No books found")
+    # El total solo se cuenta si se pide, porque COUNT(*) recorre toda la tabla
+    total = await conn.fetchval("SELECT count(*) FROM books") if include_total else None
 
-    return [{
-        "id": book["id"],
-        "title": book["title"],
-        "author": book["author"],
-        "category_id": book["category_id"],
-        "isbn": book["isbn"],
-        "copies_available": book["copies_available"],
-        "created_at": book["created_at"],
-        "updated_at": book["updated_at"]
-    } for book in books]
+    return {
+        "items": [dict(book) for book in books],
+        "next_cursor": next_cursor,
+        "total": total
+    }
 
 
 @router.put("/books/{book_id}/", response_model=BookResponse)
-async def update_book(book_id: int, book: BookUpdate, token: str = Depends(oauth2_scheme)):
+async def update_book(book_id: int, book: BookUpdate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Actualiza los detalles de un libro basado en su ID.
 
     Args:
         book_id (int): El ID del libro a editar.
         book (BookUpdate): Los nuevos datos del libro (opcional).
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles actualizados del libro.
@@ -158,113 +127,102 @@ async def update_book(book_id: int, book: BookUpdate, token: str = Depends(oauth
     Raises:
         HTTPException: Si el libro no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si el libro existe
-    cursor.execute("SELECT * FROM books WHERE id = %s", (book_id,))
-    existing_book = cursor.fetchone()
-
-    if not existing_book:
-        raise HTTPException(status_code=404, detail="Book not found")
-
     try:
-        # Actualizar los datos del libro
+        # Actualizar los datos del libro; si no existe no se devuelve ninguna fila
         query = """
             UPDATE books 
-            SET title = COALESCE(%s, title), 
-                author = COALESCE(%s, author), 
-                category_id = COALESCE(%s, category_id), 
-                isbn = COALESCE(%s, isbn), 
-                copies_available = COALESCE(%s, copies_available), 
+            SET title = COALESCE($1, title), 
+                author = COALESCE($2, author), 
+                category_id = COALESCE($3, category_id), 
+                isbn = COALESCE($4, isbn), 
+                copies_available = COALESCE($5, copies_available), 
                 updated_at = CURRENT_TIMESTAMP
-            WHERE id = %s 
+            WHERE id = $6 
             RETURNING id, title, author, category_id, isbn, copies_available, created_at, updated_at
         """
-        cursor.execute(query, (book.title, book.author, book.category_id,
-                               book.isbn, book.copies_available, book_id))
-        conn.commit()
-
-        updated_book = cursor.fetchone()
+        updated_book = await conn.fetchrow(query, book.title, book.author, book.category_id,
+                                           book.isbn, book.copies_available, book_id)
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error updating book: {str(e)}")
 
-    return {
-        "id": updated_book["id"],
-        "title": updated_book["title"],
-        "author": updated_book["author"],
-        "category_id": updated_book["category_id"],
-        "isbn": updated_book["isbn"],
-        "copies_available": updated_book["copies_available"],
-        "created_at": updated_book["created_at"],
-        "updated_at": updated_book["updated_at"],
-        "message": "Book updated successfully"
-    }
+    if updated_book is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+
+    invalidate_availability(book_id)
+
+    return dict(updated_book)
 
 
 @router.delete("/books/{book_id}/", status_code=200)
-async def delete_book(book_id: int, token: str = Depends(oauth2_scheme)):
+async def delete_book(book_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Elimina un libro basado en su ID.
 
     Args:
         book_id (int): El ID del libro a eliminar.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Raises:
         HTTPException: Si el libro no existe o si tiene préstamos o reservas activas.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si el libro existe
-    cursor.execute("SELECT * FROM books WHERE id = %s", (book_id,))
-    existing_book = cursor.fetchone()
-
-    if not existing_book:
-        raise HTTPException(status_code=404, detail="Book not found")
-
     try:
-        # Eliminar el libro
-        cursor.execute("DELETE FROM books WHERE id = %s", (book_id,))
-        conn.commit()
+        # Eliminar el libro; si no existe no se devuelve ningún id
+        deleted_id = await conn.fetchval(
+            "DELETE FROM books WHERE id = $1 RETURNING id", book_id)
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error deleting book: {str(e)}")
 
+    if deleted_id is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+
+    invalidate_availability(book_id)
+
     return {"message": "Book deleted successfully"}
 
 
 @router.get("/books/{book_id}/availability")
-async def get_book_availability(book_id: int, token: str = Depends(oauth2_scheme)):
+async def get_book_availability(book_id: int, request: Request):
     """
     Obtiene la cantidad de copias disponibles de un libro.
-    """
-    conn = get_db_connection()
-    cursor = conn.cursor()
 
-    cursor.execute("SELECT get_book_availability(%s)", (book_id,))
-    available_copies = cursor.fetchone()
+    El resultado se guarda en una caché de vida corta para que las consultas
+    repetidas del catálogo no lleguen a la base de datos. Por eso no se usa
+    get_conn: la conexión solo se pide al pool cuando la caché no tiene el dato.
+    """
+    available_copies = get_cached_availability(book_id)
 
     if available_copies is None:
-        raise HTTPException(status_code=404, detail="Book not found")
+        async with acquire_conn(request.app.state.pool) as conn:
+            available_copies = await conn.fetchval(
+                "SELECT get_book_availability($1)", book_id)
+
+        if available_copies is None:
+            raise HTTPException(status_code=404, detail="Book not found")
 
-    return {"book_id": book_id, "available_copies": available_copies[0]}
+        cache_availability(book_id, available_copies)
+
+    return {"book_id": book_id, "available_copies": available_copies}
 
 
 @router.put("/books/{book_id}/update")
-async def update_book_info(book_id: int, title: str, author: str, category_id: int, isbn: str, token: str = Depends(oauth2_scheme)):
+async def update_book_info(book_id: int, title: str, author: str, category_id: int, isbn: str, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Actualiza la información de un libro.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     try:
-        cursor.execute("SELECT update_book_info(%s, %s, %s, %s, %s)",
-                       (book_id, title, author, category_id, isbn))
-        conn.commit()
+        await conn.execute("SELECT update_book_info($1, $2, $3, $4, $5)",
+                           book_id, title, author, category_id, isbn)
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error updating book: {str(e)}")
@@ -1,19 +1,21 @@
-from fastapi import APIRouter, Depends, HTTPException
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from app.schemas.book_reservations import BookReservationCreate, BookReservationResponse
-from app.utils.database import get_db_connection
-from fastapi.security import OAuth2PasswordBearer
+from app.utils.database import get_conn, DATABASE_UNAVAILABLE_ERRORS
+from app.utils.availability_cache import invalidate_availability
 from typing import List
 
 router = APIRouter()
 
-# Esquema para autenticar a los usuarios con token JWT
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# Filas que se piden a PostgreSQL en cada vuelta al transmitir un listado completo
+STREAM_FETCH_SIZE = 500
 
 
 @router.post("/book-reservations/", response_model=BookReservationResponse)
 async def create_book_reservation(
     reservation: BookReservationCreate,
-    token: str = Depends(oauth2_scheme)
+    conn: asyncpg.Connection = Depends(get_conn)
 ):
     """
     Creates a new book reservation if the user does not already have an active reservation 
@@ -21,7 +23,7 @@ async def create_book_reservation(
 
     Args:
         reservation (BookReservationCreate): Reservation data.
-        token (str): JWT token of the authenticated user.
+        conn (asyncpg.Connection): Connection borrowed from the pool.
 
     Returns:
         dict: JSON object with details of the created reservation.
@@ -30,73 +32,36 @@ async def create_book_reservation(
         HTTPException: If the user already has an active reservation for the book 
                        or if no copies are available.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     try:
-        # Check if the user already has an active reservation for this book
-        cursor.execute("""
-            SELECT * FROM book_reservations
-            WHERE user_id = %s AND book_id = %s AND active = TRUE
-        """, (reservation.user_id, reservation.book_id))
-        existing_reservation = cursor.fetchone()
-
-        if existing_reservation:
-            raise HTTPException(
-                status_code=400,
-                detail="You already have an active reservation for this book."
-            )
-
-        # Check if there are available copies of the book
-        cursor.execute("""
-            SELECT copies_available FROM books WHERE id = %s
-        """, (reservation.book_id,))
-        book = cursor.fetchone()
-
-        if not book or book["copies_available"] <= 0:
-            raise HTTPException(
-                status_code=400,
-                detail="No available copies of this book."
-            )
-
-        # Create the new book reservation and decrement available copies
-        cursor.execute("""
-            INSERT INTO book_reservations (user_id, book_id, reservation_date, active)
-            VALUES (%s, %s, CURRENT_TIMESTAMP, TRUE)
-            RETURNING id, user_id, book_id, reservation_date, active
-        """, (reservation.user_id, reservation.book_id))
-        new_reservation = cursor.fetchone()
-
-        cursor.execute("""
-            UPDATE books SET copies_available = copies_available - 1
-            WHERE id = %s
-        """, (reservation.book_id,))
-        conn.commit()
-
-        return {
-            "id": new_reservation["id"],
-            "user_id": new_reservation["user_id"],
-            "book_id": new_reservation["book_id"],
-            "reservation_date": new_reservation["reservation_date"],
-            "active": new_reservation["active"],
-            "message": "Book reservation created successfully and copy count updated."
-        }
+        # reserve_book_v2 checks for an active reservation, decrements the
+        # available copies and inserts the reservation in a single server-side
+        # call, returning the new row
+        new_reservation = await conn.fetchrow(
+            "SELECT id, user_id, book_id, reservation_date, active FROM reserve_book_v2($1, $2)",
+            reservation.user_id, reservation.book_id)
+    except asyncpg.RaiseError as e:
+        # The function raises when the user already has an active reservation
+        # for the book or when no copies are left
+        raise HTTPException(status_code=400, detail=e.message)
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
-        conn.rollback()  # Roll back changes in case of an error
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
+
+    invalidate_availability(reservation.book_id)
+
+    return dict(new_reservation)
 
 
 @router.get("/book-reservations/{reservation_id}/", response_model=BookReservationResponse)
-async def get_book_reservation(reservation_id: int, token: str = Depends(oauth2_scheme)):
+async def get_book_reservation(reservation_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Obtiene una reserva de libro basada en su ID.
 
     Args:
         reservation_id (int): El ID de la reserva a obtener.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles de la reserva.
@@ -104,36 +69,26 @@ async def get_book_reservation(reservation_id: int, token: str = Depends(oauth2_
     Raises:
         HTTPException: Si la reserva no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Obtener la reserva por su ID
-    cursor.execute(
-        "SELECT * FROM book_reservations WHERE id = %s", (reservation_id,))
-    reservation = cursor.fetchone()
+    reservation = await conn.fetchrow(
+        "SELECT id, user_id, book_id, reservation_date, active FROM book_reservations WHERE id = $1", reservation_id)
 
     if not reservation:
         raise HTTPException(status_code=404, detail="Reservation not found")
 
-    return {
-        "id": reservation["id"],
-        "user_id": reservation["user_id"],
-        "book_id": reservation["book_id"],
-        "reservation_date": reservation["reservation_date"],
-        "active": reservation["active"],
-        "message": "Book reservation retrieved successfully"
-    }
+    # Las columnas coinciden con BookReservationResponse; el registro se entrega tal cual
+    return dict(reservation)
 
 
 @router.put("/book-reservations/{reservation_id}/", response_model=BookReservationResponse)
-async def update_book_reservation(reservation_id: int, reservation: BookReservationCreate, token: str = Depends(oauth2_scheme)):
+async def update_book_reservation(reservation_id: int, reservation: BookReservationCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Actualiza una reserva de libro basada en su ID.
 
     Args:
         reservation_id (int): El ID de la reserva a editar.
         reservation (BookReservationCreate): Los nuevos datos de la reserva.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles actualizados de la reserva.
@@ -141,138 +96,141 @@ async def update_book_reservation(reservation_id: int, reservation: BookReservat
     Raises:
         HTTPException: Si la reserva no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si la reserva existe
-    cursor.execute(
-        "SELECT * FROM book_reservations WHERE id = %s", (reservation_id,))
-    existing_reservation = cursor.fetchone()
-
-    if not existing_reservation:
-        raise HTTPException(status_code=404, detail="Reservation not found")
-
-    # Actualizar la reserva de libro
+    # Actualizar la reserva de libro; si no existe no se devuelve ninguna fila
     query = """
         UPDATE book_reservations 
-        SET user_id = %s, book_id = %s, reservation_date = CURRENT_TIMESTAMP
-        WHERE id = %s 
+        SET user_id = $1, book_id = $2, reservation_date = CURRENT_TIMESTAMP
+        WHERE id = $3 
         RETURNING id, user_id, book_id, reservation_date, active
     """
-    cursor.execute(query, (reservation.user_id,
-                   reservation.book_id, reservation_id))
-    conn.commit()
+    updated_reservation = await conn.fetchrow(query, reservation.user_id,
+                                              reservation.book_id, reservation_id)
 
-    updated_reservation = cursor.fetchone()
+    if updated_reservation is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+
+    return dict(updated_reservation)
 
-    return {
-        "id": updated_reservation["id"],
-        "user_id": updated_reservation["user_id"],
-        "book_id": updated_reservation["book_id"],
-        "reservation_date": updated_reservation["reservation_date"],
-        "active": updated_reservation["active"],
-        "message": "Book reservation updated successfully"
-    }
+
+async def _stream_reservations(conn: asyncpg.Connection):
+    """
+    Genera el arreglo JSON de todas las reservas por partes.
+
+    Las filas se leen con un cursor del servidor de STREAM_FETCH_SIZE en
+    STREAM_FETCH_SIZE, y PostgreSQL entrega cada una ya convertida a JSON, así
+    que ni la base de datos ni la aplicación arman el listado completo en memoria.
+
+    Args:
+        conn (asyncpg.Connection): Conexión prestada del pool.
+
+    Yields:
+        bytes: Fragmentos consecutivos del arreglo JSON.
+    """
+    # Los cursores de asyncpg solo existen dentro de una transacción
+    async with conn.transaction():
+        cursor = await conn.cursor("""
+            SELECT json_build_object(
+                       'id', id, 'user_id', user_id, 'book_id', book_id,
+                       'reservation_date', reservation_date, 'active', active
+                   )::text
+            FROM book_reservations
+            ORDER BY id
+        """)
+
+        separator = "["
+        while rows := await cursor.fetch(STREAM_FETCH_SIZE):
+            yield (separator + ",".join(row[0] for row in rows)).encode()
+            separator = ","
+
+        yield b"[]" if separator == "[" else b"]"
 
 
 @router.get("/book-reservations/", response_model=List[BookReservationResponse])
-async def list_book_reservations(token: str = Depends(oauth2_scheme)):
+async def list_book_reservations(conn: asyncpg.Connection = Depends(get_conn)):
     """
     Obtiene una lista de todas las reservas de libros en la base de datos.
 
     Args:
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
-        list: Una lista de todas las reservas de libros.
+        StreamingResponse: El JSON con la lista de todas las reservas de libros.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Obtener todas las reservas de libros
-    cursor.execute("SELECT * FROM book_reservations")
-    reservations = cursor.fetchall()
-
-    return [{
-        "id": reservation["id"],
-        "user_id": reservation["user_id"],
-        "book_id": reservation["book_id"],
-        "reservation_date": reservation["reservation_date"],
-        "active": reservation["active"]
-    } for reservation in reservations]
+    # El listado no tiene límite, así que se transmite mientras se lee; la
+    # conexión se devuelve al pool cuando termina la respuesta (FastAPI >= 0.118
+    # cierra get_conn después de enviar el cuerpo, no antes). response_model
+    # se conserva solo para documentar la respuesta.
+    return StreamingResponse(_stream_reservations(conn), media_type="application/json")
 
 
 @router.delete("/book-reservations/{reservation_id}/", status_code=204)
-async def delete_book_reservation(reservation_id: int, token: str = Depends(oauth2_scheme)):
+async def delete_book_reservation(reservation_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Elimina una reserva de libro basada en su ID.
 
     Args:
         reservation_id (int): El ID de la reserva a eliminar.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Raises:
         HTTPException: Si la reserva no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Eliminar la reserva de libro; si no existe no se devuelve ningún id
+    deleted_id = await conn.fetchval(
+        "DELETE FROM book_reservations WHERE id = $1 RETURNING id", reservation_id)
 
-    # Verificar si la reserva existe
-    cursor.execute(
-        "SELECT * FROM book_reservations WHERE id = %s", (reservation_id,))
-    existing_reservation = cursor.fetchone()
-
-    if not existing_reservation:
+    if deleted_id is None:
         raise HTTPException(status_code=404, detail="Reservation not found")
 
-    # Eliminar la reserva de libro
-    cursor.execute("DELETE FROM book_reservations WHERE id = %s",
-                   (reservation_id,))
-    conn.commit()
-
     return {"message": "Book reservation deleted successfully"}
 
 
 @router.post("/reservations/")
-async def reserve_book(user_id: int, book_id: int, token: str = Depends(oauth2_scheme)):
+async def reserve_book(user_id: int, book_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Realiza una reserva de un libro si hay copias disponibles.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     try:
-        cursor.execute("SELECT reserve_book(%s, %s)", (user_id, book_id))
-        conn.commit()
+        await conn.execute("SELECT reserve_book($1, $2)", user_id, book_id)
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+    invalidate_availability(book_id)
+
     return {"message": "Book reserved successfully."}
 
 
-@router.get("/reservations/user/{user_id}")
-async def get_user_reservations(user_id: int, token: str = Depends(oauth2_scheme)):
+@router.get("/reservations/user/{user_id}", response_model=List[BookReservationResponse])
+async def get_user_reservations(user_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
-    Obtiene todas las reservas activas de un usuario.
+    Obtiene todas las reservas activas de un usuario. El JSON lo arma PostgreSQL.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute(
-        "SELECT * FROM book_reservations WHERE user_id = %s AND active = TRUE", (user_id,))
-    reservations = cursor.fetchall()
+    reservations = await conn.fetchval("""
+        SELECT COALESCE(json_agg(json_build_object(
+                   'id', id, 'user_id', user_id, 'book_id', book_id,
+                   'reservation_date', reservation_date, 'active', active
+               ) ORDER BY id), '[]')::text
+        FROM book_reservations
+        WHERE user_id = $1 AND active = TRUE
+    """, user_id)
 
-    return [{"id": reservation["id"], "book_id": reservation["book_id"], "reservation_date": reservation["reservation_date"], "active": reservation["active"]} for reservation in reservations]
+    # Se devuelve el JSON tal cual, sin pasar por BookReservationResponse;
+    # response_model se conserva solo para documentar la respuesta, así que las
+    # columnas de json_build_object deben coincidir con los campos del esquema.
+    return Response(content=reservations, media_type="application/json")
 
 
 @router.put("/book-reservations/{reservation_id}/fulfill", response_model=BookReservationResponse)
-async def fulfill_book_reservation(reservation_id: int, token: str = Depends(oauth2_scheme)):
+async def fulfill_book_reservation(reservation_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Marca una reserva de libro como cumplida (inactiva) y aumenta en uno la cantidad de copias disponibles del libro.
 
     Args:
         reservation_id (int): El ID de la reserva a cumplir.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles de la reserva cumplida.
@@ -280,50 +238,34 @@ async def fulfill_book_reservation(reservation_id: int, token: str = Depends(oau
     Raises:
         HTTPException: Si la reserva no existe o ya está cumplida.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     try:
-        # Verificar si la reserva existe y está activa
-        cursor.execute("""
-            SELECT * FROM book_reservations 
-            WHERE id = %s AND active = TRUE
-        """, (reservation_id,))
-        reservation = cursor.fetchone()
-
-        if not reservation:
+        # Marcar la reserva activa como cumplida y devolver la copia al libro en una
+        # sola sentencia; si la reserva no existe o ya está cumplida no cambia nada
+        fulfilled_reservation = await conn.fetchrow("""
+            WITH fulfilled AS (
+                UPDATE book_reservations 
+                SET active = FALSE 
+                WHERE id = $1 AND active = TRUE 
+                RETURNING id, user_id, book_id, reservation_date, active
+            ), restock AS (
+                UPDATE books 
+                SET copies_available = copies_available + 1 
+                WHERE id = (SELECT book_id FROM fulfilled)
+            )
+            SELECT id, user_id, book_id, reservation_date, active FROM fulfilled
+        """, reservation_id)
+
+        if not fulfilled_reservation:
             raise HTTPException(
                 status_code=404, detail="Reservation not found or already fulfilled")
 
-        # Marcar la reserva como cumplida
-        cursor.execute("""
-            UPDATE book_reservations 
-            SET active = FALSE 
-            WHERE id = %s 
-            RETURNING id, user_id, book_id, reservation_date, active
-        """, (reservation_id,))
-        fulfilled_reservation = cursor.fetchone()
-
-        # Aumentar en uno las copias disponibles del libro
-        cursor.execute("""
-            UPDATE books 
-            SET copies_available = copies_available + 1 
-            WHERE id = %s
-        """, (fulfilled_reservation["book_id"],))
-
-        conn.commit()
-
-        return {
-            "id": fulfilled_reservation["id"],
-            "user_id": fulfilled_reservation["user_id"],
-            "book_id": fulfilled_reservation["book_id"],
-            "reservation_date": fulfilled_reservation["reservation_date"],
-            "active": fulfilled_reservation["active"],
-            "message": "Book reservation fulfilled and copy count updated"
-        }
+        invalidate_availability(fulfilled_reservation["book_id"])
+
+        return dict(fulfilled_reservation)
+    except HTTPException:
+        raise
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
-        conn.rollback()  # Revertir cambios en caso de error
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
@@ -1,23 +1,20 @@
+import asyncpg
 from fastapi import APIRouter, Depends, HTTPException, Query
-from app.schemas.category import CategoryCreate, CategoryResponse
-from app.utils.database import get_db_connection
-from fastapi.security import OAuth2PasswordBearer
-from typing import List
+from app.schemas.category import CategoryCreate, CategoryResponse, CategoryPage
+from app.utils.database import get_conn, DATABASE_UNAVAILABLE_ERRORS
+from app.utils.category_cache import get_cached_category, cache_category, invalidate_category
 
 router = APIRouter()
 
-# Esquema para autenticar a los usuarios con token JWT
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-
 
 @router.post("/categories/", response_model=CategoryResponse)
-async def create_category(category: CategoryCreate, token: str = Depends(oauth2_scheme)):
+async def create_category(category: CategoryCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Crea una nueva categoría en la base de datos.
 
     Args:
         category (CategoryCreate): Datos de la categoría a crear.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles de la categoría creada.
@@ -25,45 +22,43 @@ async def create_category(category: CategoryCreate, token: str = Depends(oauth2_
     Raises:
         HTTPException: Si ya existe una categoría con el mismo nombre.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si la categoría ya existe
-    cursor.execute("SELECT * FROM categories WHERE name = %s",
-                   (category.name,))
-    existing_category = cursor.fetchone()
-
-    if existing_category:
-        raise HTTPException(
-            status_code=400, detail="Category with this name already exists"
-        )
-
     try:
-        # Crear la nueva categoría
+        # Crear la nueva categoría; si el nombre ya existe no se inserta ni se
+        # devuelve ninguna fila. Lo decide siempre la base de datos (el nombre es
+        # UNIQUE), nunca la caché, que puede estar desactualizada
         query = """
             INSERT INTO categories (name)
-            VALUES (%s)
+            VALUES ($1)
+            ON CONFLICT (name) DO NOTHING
             RETURNING id, name
         """
-        cursor.execute(query, (category.name,))
-        conn.commit()
-
-        new_category = cursor.fetchone()
+        new_category = await conn.fetchrow(query, category.name)
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error creating category: {str(e)}")
 
-    return {"id": new_category["id"], "name": new_category["name"], "message": "Category created successfully"}
+    if new_category is None:
+        raise HTTPException(
+            status_code=400, detail="Category with this name already exists"
+        )
+
+    new_category = dict(new_category)
+    cache_category(new_category)
+
+    return new_category
 
 
 @router.get("/categories/{category_id}/", response_model=CategoryResponse)
-async def get_category(category_id: int, token: str = Depends(oauth2_scheme)):
+async def get_category(category_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Obtiene una categoría basada en su ID.
 
     Args:
         category_id (int): El ID de la categoría a obtener.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles de la categoría.
@@ -71,57 +66,63 @@ async def get_category(category_id: int, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si la categoría no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Obtener la categoría por su ID, primero desde la caché
+    category = get_cached_category(category_id)
+    if category is not None:
+        return category
 
-    # Obtener la categoría por su ID
-    cursor.execute("SELECT * FROM categories WHERE id = %s", (category_id,))
-    category = cursor.fetchone()
+    category = await conn.fetchrow(
+        "SELECT id, name FROM categories WHERE id = $1", category_id)
 
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
 
-    return {"id": category["id"], "name": category["name"], "message": "Category retrieved successfully"}
+    category = dict(category)
+    cache_category(category)
+
+    return category
 
 
-@router.get("/categories/", response_model=List[CategoryResponse])
-async def get_all_categories(page: int = Query(1, ge=1), per_page: int = Query(40, ge=1, le=100), token: str = Depends(oauth2_scheme)):
+@router.get("/categories/", response_model=CategoryPage)
+async def get_all_categories(after_id: int = Query(0, ge=0), per_page: int = Query(40, ge=1, le=100), include_total: bool = Query(False), conn: asyncpg.Connection = Depends(get_conn)):
     """
-    Obtiene todas las categorías en la base de datos con paginación.
+    Obtiene las categorías de la base de datos con paginación por cursor (keyset).
 
     Args:
-        page (int): Número de página (por defecto 1).
-        per_page (int): Número de categorías por página (por defecto 10, máximo 100).
-        token (str): El token JWT del usuario autenticado.
+        after_id (int): ID de la última categoría de la página anterior (0 para la primera página).
+        per_page (int): Número de categorías por página (por defecto 40, máximo 100).
+        include_total (bool): Si es True también se devuelve el total de categorías (total).
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
-        list[CategoryResponse]: Una lista de todas las categorías.
+        dict: Las categorías de la página y el cursor de la siguiente (next_cursor).
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Obtener la página de categorías a partir del cursor
+    categories = await conn.fetch(
+        "SELECT id, name FROM categories WHERE id > $1 ORDER BY id LIMIT $2", after_id, per_page)
 
-    offset = (page - 1) * per_page
+    # Si la página está completa puede haber más categorías después del último ID
+    next_cursor = categories[-1]["id"] if len(categories) == per_page else None
 
-    # Obtener todas las categorías con paginación
-    cursor.execute("SELECT * FROM categories LIMIT %s OFFSET %s",
-                   (per_page, offset))
-    categories = cursor.fetchall()
+    # El total solo se cuenta si se pide, porque COUNT(*) recorre toda la tabla
+    total = await conn.fetchval("SELECT count(*) FROM categories") if include_total else None
 
-    if not categories:
-        raise HTTPException(status_code=404, detail="No categories found")
-
-    return [{"id": category["id"], "name": category["name"]} for category in categories]
+    return {
+        "items": [dict(category) for category in categories],
+        "next_cursor": next_cursor,
+        "total": total
+    }
 
 
 @router.put("/categories/{category_id}/", response_model=CategoryResponse)
-async def update_category(category_id: int, category: CategoryCreate, token: str = Depends(oauth2_scheme)):
+async def update_category(category_id: int, category: CategoryCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Actualiza los detalles de una categoría basada en su ID.
 
     Args:
         category_id (int): El ID de la categoría a editar.
         category (CategoryCreate): Los nuevos datos de la categoría.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles actualizados de la categoría.
@@ -129,72 +130,64 @@ async def update_category(category_id: int, category: CategoryCreate, token: str
     Raises:
         HTTPException: Si la categoría no existe o si el nombre ya está en uso.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si la categoría existe
-    cursor.execute("SELECT * FROM categories WHERE id = %s", (category_id,))
-    existing_category = cursor.fetchone()
-
-    if not existing_category:
-        raise HTTPException(status_code=404, detail="Category not found")
-
-    # Verificar si el nuevo nombre ya está en uso por otra categoría
-    cursor.execute("SELECT * FROM categories WHERE name = %s AND id != %s",
-                   (category.name, category_id))
-    duplicate_category = cursor.fetchone()
-
-    if duplicate_category:
-        raise HTTPException(
-            status_code=400, detail="Category with this name already exists")
-
     try:
-        # Actualizar la categoría
+        # Actualizar la categoría; si no existe no se devuelve ninguna fila. El
+        # nombre es UNIQUE, así que un nombre en uso por otra categoría lo rechaza
+        # la propia base de datos sin una consulta previa
         query = """
             UPDATE categories 
-            SET name = %s 
-            WHERE id = %s 
+            SET name = $1 
+            WHERE id = $2 
             RETURNING id, name
         """
-        cursor.execute(query, (category.name, category_id))
-        conn.commit()
-
-        updated_category = cursor.fetchone()
+        updated_category = await conn.fetchrow(query, category.name, category_id)
+    except asyncpg.UniqueViolationError:
+        raise HTTPException(
+            status_code=400, detail="Category with this name already exists")
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error updating category: {str(e)}")
 
-    return {"id": updated_category["id"], "name": updated_category["name"], "message": "Category updated successfully"}
+    if updated_category is None:
+        raise HTTPException(status_code=404, detail="Category not found")
+
+    # Reemplazar la entrada en caché con los datos actualizados
+    updated_category = dict(updated_category)
+    invalidate_category(category_id)
+    cache_category(updated_category)
+
+    return updated_category
 
 
 @router.delete("/categories/{category_id}/", status_code=200)
-async def delete_category(category_id: int, token: str = Depends(oauth2_scheme)):
+async def delete_category(category_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Elimina una categoría basada en su ID.
 
     Args:
         category_id (int): El ID de la categoría a eliminar.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Raises:
         HTTPException: Si la categoría no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si la categoría existe
-    cursor.execute("SELECT * FROM categories WHERE id = %s", (category_id,))
-    existing_category = cursor.fetchone()
-
-    if not existing_category:
-        raise HTTPException(status_code=404, detail="Category not found")
-
     try:
-        # Eliminar la categoría
-        cursor.execute("DELETE FROM categories WHERE id = %s", (category_id,))
-        conn.commit()
+        # Eliminar la categoría; si no existe no se devuelve ningún id
+        deleted_id = await conn.fetchval(
+            "DELETE FROM categories WHERE id = $1 RETURNING id", category_id)
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error deleting category: {str(e)}")
 
+    if deleted_id is None:
+        raise HTTPException(status_code=404, detail="Category not found")
+
+    invalidate_category(category_id)
+
     return {"message": "Category deleted successfully"}
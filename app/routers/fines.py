@@ -1,70 +1,60 @@
-from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, Query
-from app.schemas.fines import FineCreate, FineResponse
-from app.utils.database import get_db_connection
-from fastapi.security import OAuth2PasswordBearer
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from app.schemas.fines import FineCreate, FineResponse, FinePage
+from app.utils.database import get_conn, DATABASE_UNAVAILABLE_ERRORS
+from app.utils.etag import compute_etag, is_not_modified
 from typing import List
 
 router = APIRouter()
 
-# Esquema para autenticar a los usuarios con token JWT
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-
 
 @router.post("/fines/", response_model=FineResponse)
-async def create_fine(fine: FineCreate, token: str = Depends(oauth2_scheme)):
+async def create_fine(fine: FineCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Crea una nueva multa.
 
     Args:
         fine (FineCreate): Datos de la multa a crear.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles de la multa creada.
 
     Raises:
-        HTTPException: Si ocurre algún error al crear la multa.
+        HTTPException: Si el préstamo ya tiene una multa pendiente o si ocurre algún error al crear la multa.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     try:
         # Crear la nueva multa
         query = """
             INSERT INTO fines (user_id, loan_id, amount, description, fine_date, paid)
-            VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP, FALSE)
+            VALUES ($1, $2, $3, $4, CURRENT_TIMESTAMP, FALSE)
             RETURNING id, user_id, loan_id, amount, description, paid, fine_date
         """
-        cursor.execute(query, (fine.user_id, fine.loan_id,
-                       fine.amount, fine.description))
-        conn.commit()
-
-        new_fine = cursor.fetchone()
+        new_fine = await conn.fetchrow(query, fine.user_id, fine.loan_id,
+                                       fine.amount, fine.description)
+    except asyncpg.UniqueViolationError:
+        raise HTTPException(
+            status_code=400, detail="This loan already has an unpaid fine")
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error creating fine: {str(e)}")
 
-    return {
-        "id": new_fine["id"],
-        "user_id": new_fine["user_id"],
-        "loan_id": new_fine["loan_id"],
-        "amount": new_fine["amount"],
-        "description": new_fine["description"],
-        "paid": new_fine["paid"],
-        "fine_date": new_fine["fine_date"],
-        "message": "Fine created successfully"
-    }
+    return dict(new_fine)
 
 
 @router.get("/fines/{fine_id}/", response_model=FineResponse)
-async def get_fine(fine_id: int, token: str = Depends(oauth2_scheme)):
+async def get_fine(fine_id: int, request: Request, response: Response, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Obtiene una multa basada en su ID.
 
     Args:
         fine_id (int): El ID de la multa a obtener.
-        token (str): El token JWT del usuario autenticado.
+        request (Request): La petición actual (para leer If-None-Match).
+        response (Response): La respuesta, donde se agrega la cabecera ETag.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles de la multa.
@@ -72,36 +62,30 @@ async def get_fine(fine_id: int, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si la multa no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Obtener la multa por su ID
-    cursor.execute("SELECT * FROM fines WHERE id = %s", (fine_id,))
-    fine = cursor.fetchone()
+    fine = await conn.fetchrow(
+        "SELECT id, user_id, loan_id, amount, description, paid, fine_date FROM fines WHERE id = $1", fine_id)
 
     if not fine:
         raise HTTPException(status_code=404, detail="Fine not found")
 
-    return {
-        "id": fine["id"],
-        "user_id": fine["user_id"],
-        "loan_id": fine["loan_id"],
-        "amount": fine["amount"],
-        "description": fine["description"],
-        "paid": fine["paid"],
-        "fine_date": fine["fine_date"],
-        "message": "Fine retrieved successfully"
-    }
+    # Si el cliente ya tiene esta versión de la multa se responde 304 sin cuerpo
+    etag = compute_etag(*fine.values())
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    return dict(fine)
 
 
 @router.put("/fines/{fine_id}/pay", response_model=FineResponse)
-async def pay_fine(fine_id: int, token: str = Depends(oauth2_scheme)):
+async def pay_fine(fine_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Actualiza el estado de pago de una multa.
 
     Args:
         fine_id (int): El ID de la multa a actualizar.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles de la multa actualizada.
@@ -109,170 +93,110 @@ async def pay_fine(fine_id: int, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si la multa no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si la multa existe
-    cursor.execute("SELECT * FROM fines WHERE id = %s", (fine_id,))
-    existing_fine = cursor.fetchone()
-
-    if not existing_fine:
-        raise HTTPException(status_code=404, detail="Fine not found")
-
-    # Actualizar el estado de pago de la multa
+    # Actualizar el estado de pago de la multa; si no existe no se devuelve ninguna fila
     query = """
         UPDATE fines 
         SET paid = TRUE 
-        WHERE id = %s 
+        WHERE id = $1 
         RETURNING id, user_id, loan_id, amount, description, paid, fine_date
     """
-    cursor.execute(query, (fine_id,))
-    conn.commit()
+    updated_fine = await conn.fetchrow(query, fine_id)
 
-    updated_fine = cursor.fetchone()
-
-    return {
-        "id": updated_fine["id"],
-        "user_id": updated_fine["user_id"],
-        "loan_id": updated_fine["loan_id"],
-        "amount": updated_fine["amount"],
-        "description": updated_fine["description"],
-        "paid": updated_fine["paid"],
-        "fine_date": updated_fine["fine_date"],
-        "message": "Fine paid successfully"
-    }
+    if updated_fine is None:
+        raise HTTPException(status_code=404, detail="Fine not found")
 
-# Parámetros de la multa
-INITIAL_FINE = 100  # Multa inicial después del período de gracia
-DAILY_FINE = 10  # Multa diaria adicional por cada día después del período de gracia
-GRACE_PERIOD_DAYS = 7  # Días de gracia sin multa
+    return dict(updated_fine)
 
 
-@router.get("/fines/", response_model=List[FineResponse])
-async def list_fines(page: int = Query(1, ge=1), per_page: int = Query(10, ge=1, le=100), token: str = Depends(oauth2_scheme)):
+@router.get("/fines/", response_model=FinePage)
+async def list_fines(after_id: int = Query(0, ge=0), per_page: int = Query(10, ge=1, le=100), include_total: bool = Query(False), conn: asyncpg.Connection = Depends(get_conn)):
     """
-    Obtiene una lista de todas las multas con paginación y genera o recalcula automáticamente multas para préstamos vencidos.
+    Obtiene las multas con paginación por cursor (keyset).
+
+    Las multas de préstamos vencidos se generan y recalculan en segundo plano
+    (ver app/utils/fines.py), por lo que esta ruta solo lee.
+
+    Args:
+        after_id (int): ID de la última multa de la página anterior (0 para la primera página).
+        per_page (int): Número de multas por página (por defecto 10, máximo 100).
+        include_total (bool): Si es True también se devuelve el total de multas (total).
+        conn (asyncpg.Connection): Conexión prestada del pool.
+
+    Returns:
+        dict: Las multas de la página y el cursor de la siguiente (next_cursor).
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    offset = (page - 1) * per_page
-    current_date = datetime.utcnow()
-
-    # Step 1: Find overdue loans that have not been returned
-    cursor.execute("SELECT * FROM loans WHERE returned = FALSE")
-    overdue_loans = cursor.fetchall()
-
-    for loan in overdue_loans:
-        loan_id = loan["id"]
-        user_id = loan["user_id"]
-        loan_date = loan["loan_date"]
-
-        # Calculate total overdue days after the grace period
-        overdue_days = (current_date - loan_date).days - GRACE_PERIOD_DAYS
-        if overdue_days > 0:
-            # Check if there's an existing unpaid fine for this loan
-            cursor.execute(
-                "SELECT * FROM fines WHERE loan_id = %s AND paid = FALSE ORDER BY fine_date DESC LIMIT 1",
-                (loan_id,)
-            )
-            existing_fine = cursor.fetchone()
-
-            total_fine_amount = INITIAL_FINE + (overdue_days * DAILY_FINE)
-            description = f"Multa por exceso de días ({overdue_days} días excedidos)"
-
-            if existing_fine:
-                # Fine already exists, update it with the recalculated fine amount
-                cursor.execute("""
-                    UPDATE fines
-                    SET amount = %s, description = %s, fine_date = %s
-                    WHERE id = %s
-                """, (total_fine_amount, description, current_date, existing_fine["id"]))
-            else:
-                # No previous fine, create an initial fine for the overdue period
-                cursor.execute("""
-                    INSERT INTO fines (user_id, loan_id, amount, description, paid, fine_date)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (user_id, loan_id, total_fine_amount, description, False, current_date))
-
-    conn.commit()
-
-    # Step 2: Retrieve all fines with pagination
-    cursor.execute("SELECT * FROM fines LIMIT %s OFFSET %s",
-                   (per_page, offset))
-    fines = cursor.fetchall()
-
-    if not fines:
-        raise HTTPException(status_code=404, detail="No fines found")
-
-    return [{
-        "id": fine["id"],
-        "user_id": fine["user_id"],
-        "loan_id": fine["loan_id"],
-        "amount": fine["amount"],
-        "description": fine["description"],
-        "paid": fine["paid"],
-        "fine_date": fine["fine_date"]
-    } for fine in fines]
+    # Obtener la página de multas a partir del cursor (recorre el índice de la llave primaria)
+    fines = await conn.fetch("""
+        SELECT id, user_id, loan_id, amount, description, paid, fine_date
+        FROM fines WHERE id > $1 ORDER BY id LIMIT $2
+    """, after_id, per_page)
+
+    # Si la página está completa puede haber más multas después del último ID
+    next_cursor = fines[-1]["id"] if len(fines) == per_page else None
+
+    # El total solo se cuenta si se pide, porque COUNT(*) recorre toda la tabla
+    total = await conn.fetchval("SELECT count(*) FROM fines") if include_total else None
+
+    return {
+        "items": [dict(fine) for fine in fines],
+        "next_cursor": next_cursor,
+        "total": total
+    }
 
 
 @router.delete("/fines/{fine_id}/", status_code=200)
-async def delete_fine(fine_id: int, token: str = Depends(oauth2_scheme)):
+async def delete_fine(fine_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Elimina una multa basada en su ID.
 
     Args:
         fine_id (int): El ID de la multa a eliminar.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Raises:
         HTTPException: Si la multa no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Eliminar la multa; si no existe no se devuelve ningún id
+    deleted_id = await conn.fetchval(
+        "DELETE FROM fines WHERE id = $1 RETURNING id", fine_id)
 
-    # Verificar si la multa existe
-    cursor.execute("SELECT * FROM fines WHERE id = %s", (fine_id,))
-    existing_fine = cursor.fetchone()
-
-    if not existing_fine:
+    if deleted_id is None:
         raise HTTPException(status_code=404, detail="Fine not found")
 
-    # Eliminar la multa
-    cursor.execute("DELETE FROM fines WHERE id = %s", (fine_id,))
-    conn.commit()
-
     return {"message": "Fine deleted successfully"}
 
 
 @router.get("/fines/user/{user_id}/", response_model=List[FineResponse])
-async def get_user_fines(user_id: int, token: str = Depends(oauth2_scheme)):
+async def get_user_fines(user_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Obtiene todas las multas de un usuario.
 
     Args:
         user_id (int): El ID del usuario.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
-        list: Una lista de todas las multas del usuario.
+        Response: El JSON con la lista de todas las multas del usuario.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Obtener todas las multas del usuario
-    cursor.execute("SELECT * FROM get_user_fines(%s)", (user_id,))
-    fines = cursor.fetchall()
-
-    if not fines:
+    # Obtener todas las multas del usuario (consulta directa sobre idx_fines_user_date,
+    # que también entrega las filas ya ordenadas por fine_date DESC, el mismo orden
+    # que la función get_user_fines). PostgreSQL arma el JSON completo; el monto
+    # se envía como texto, igual que lo serializa FineResponse
+    fines = await conn.fetchval("""
+        SELECT json_agg(json_build_object(
+                   'id', id, 'user_id', user_id, 'loan_id', loan_id,
+                   'amount', amount::text, 'description', description,
+                   'paid', paid, 'fine_date', fine_date
+               ) ORDER BY fine_date DESC)::text
+        FROM fines
+        WHERE user_id = $1
+    """, user_id)
+
+    if fines is None:
         raise HTTPException(
             status_code=404, detail="No fines found for the user")
 
-    return [{
-        "id": fine["id"],
-        "user_id": fine["user_id"],
-        "loan_id": fine["loan_id"],
-        "amount": fine["amount"],
-        "description": fine["description"],
-        "paid": fine["paid"],
-        "fine_date": fine["fine_date"]
-    } for fine in fines]
+    # Se devuelve el JSON tal cual, sin pasar por FineResponse; response_model se
+    # conserva solo para documentar la respuesta, así que las columnas de
+    # json_build_object deben coincidir con los campos del esquema.
+    return Response(content=fines, media_type="application/json")
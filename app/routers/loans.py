@@ -1,26 +1,23 @@
-"""endpoints para los préstamos"""
-from fastapi import APIRouter, Depends, HTTPException, Query
-from app.schemas.loans import LoanCreate, LoanResponse
-from app.utils.database import get_db_connection
-from fastapi.security import OAuth2PasswordBearer
-from typing import List
-from datetime import datetime
+"""endpoints para los préstamos"""
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from app.schemas.loans import LoanCreate, LoanResponse, LoanPage
+from app.utils.database import get_conn, DATABASE_UNAVAILABLE_ERRORS
+from app.utils.availability_cache import invalidate_availability
+from app.utils.etag import compute_etag, is_not_modified
 
 router = APIRouter()
 
-# Esquema para autenticar a los usuarios con token JWT
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-
 
 @router.post("/loans/", response_model=LoanResponse)
-async def create_loan(loan: LoanCreate, token: str = Depends(oauth2_scheme)):
+async def create_loan(loan: LoanCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Creates a new loan if copies are available and the user doesn't already have an active loan for the book.
     Updates the stock count of available copies for the book.
 
     Args:
         loan (LoanCreate): Loan data (user and book).
-        token (str): The JWT token of the authenticated user.
+        conn (asyncpg.Connection): Connection borrowed from the pool.
 
     Returns:
         dict: A JSON object with details of the created loan.
@@ -28,66 +25,37 @@ async def create_loan(loan: LoanCreate, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: If the user already has an active loan for the book or if no copies are available.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     try:
-        # Check if there are copies available
-        cursor.execute(
-            "SELECT copies_available FROM books WHERE id = %s", (loan.book_id,))
-        book = cursor.fetchone()
-
-        if not book or book["copies_available"] <= 0:
-            raise HTTPException(
-                status_code=400, detail="No copies available for this book.")
-
-        # Check if the user already has an active loan for this book
-        cursor.execute(
-            "SELECT * FROM loans WHERE book_id = %s AND user_id = %s AND returned = FALSE",
-            (loan.book_id, loan.user_id))
-        user_existing_loan = cursor.fetchone()
-
-        if user_existing_loan:
-            raise HTTPException(
-                status_code=400, detail="You already have an active loan for this book.")
-
-        # Create the new loan and update the number of available copies
-        cursor.execute("""
-            INSERT INTO loans (user_id, book_id)
-            VALUES (%s, %s)
-            RETURNING id, user_id, book_id, loan_date, return_date, returned
-        """, (loan.user_id, loan.book_id))
-        new_loan = cursor.fetchone()
-
-        cursor.execute(
-            "UPDATE books SET copies_available = copies_available - 1 WHERE id = %s", (loan.book_id,))
-        conn.commit()
-
-        return {
-            "id": new_loan["id"],
-            "user_id": new_loan["user_id"],
-            "book_id": new_loan["book_id"],
-            "loan_date": new_loan["loan_date"],
-            "return_date": new_loan["return_date"],
-            "returned": new_loan["returned"],
-            "message": "Loan created successfully, and the number of available copies updated."
-        }
+        # create_loan takes the copy, checks for an active loan and inserts the
+        # loan in a single server-side call, returning the new row. The book row
+        # stays locked until the commit, so concurrent loans cannot take the
+        # same last copy
+        new_loan = await conn.fetchrow(
+            "SELECT id, user_id, book_id, loan_date, return_date, returned FROM create_loan($1, $2)",
+            loan.user_id, loan.book_id)
+    except asyncpg.RaiseError as e:
+        # The function raises when no copies are left or when the user already
+        # has an active loan for the book
+        raise HTTPException(status_code=400, detail=e.message)
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Lost connections propagate so the app answers 503
+        raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
+
+    invalidate_availability(loan.book_id)
+
+    return dict(new_loan)
 
 
 @router.put("/loans/{loan_id}/return", response_model=LoanResponse)
-async def return_book(loan_id: int, token: str = Depends(oauth2_scheme)):
+async def return_book(loan_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Marca un préstamo como devuelto, actualiza la fecha de devolución y suma una copia disponible.
 
     Args:
         loan_id (int): El ID del préstamo a marcar como devuelto.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles del préstamo actualizado.
@@ -95,97 +63,77 @@ async def return_book(loan_id: int, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si el préstamo no existe o ya ha sido devuelto.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     try:
-        # Verificar si el préstamo existe
-        cursor.execute("SELECT * FROM loans WHERE id = %s", (loan_id,))
-        loan = cursor.fetchone()
-
-        if not loan:
-            raise HTTPException(
-                status_code=404, detail="Préstamo no encontrado")
-
-        if loan["returned"]:
-            raise HTTPException(
-                status_code=400, detail="Este préstamo ya ha sido devuelto.")
-
-        # Marcar el préstamo como devuelto, actualizar la fecha de devolución y aumentar copias
-        cursor.execute("""
-            UPDATE loans
-            SET returned = TRUE, return_date = %s
-            WHERE id = %s
-            RETURNING id, user_id, book_id, loan_date, return_date, returned
-        """, (datetime.utcnow(), loan_id))
-        updated_loan = cursor.fetchone()
-
-        cursor.execute(
-            "UPDATE books SET copies_available = copies_available + 1 WHERE id = %s", (loan["book_id"],))
-        conn.commit()
-
-        return {
-            "id": updated_loan["id"],
-            "user_id": updated_loan["user_id"],
-            "book_id": updated_loan["book_id"],
-            "loan_date": updated_loan["loan_date"],
-            "return_date": updated_loan["return_date"],
-            "returned": updated_loan["returned"],
-            "message": "Libro devuelto y copias actualizadas correctamente"
-        }
+        # return_loan marca el préstamo como devuelto y suma la copia al libro en
+        # una sola llamada, devolviendo la fila actualizada
+        returned_loan = await conn.fetchrow(
+            "SELECT id, user_id, book_id, loan_date, return_date, returned FROM return_loan($1)",
+            loan_id)
+    except asyncpg.NoDataFoundError as e:
+        # El préstamo no existe
+        raise HTTPException(status_code=404, detail=e.message)
+    except asyncpg.RaiseError as e:
+        # El préstamo ya había sido devuelto
+        raise HTTPException(status_code=400, detail=e.message)
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
 
+    invalidate_availability(returned_loan["book_id"])
 
-@router.get("/loans/", response_model=List[LoanResponse])
+    return dict(returned_loan)
+
+
+@router.get("/loans/", response_model=LoanPage)
 async def get_all_loans(
-    page: int = Query(1, ge=1),
+    after_id: int = Query(0, ge=0),
     per_page: int = Query(10, ge=1, le=100),
-    token: str = Depends(oauth2_scheme)
+    include_total: bool = Query(False),
+    conn: asyncpg.Connection = Depends(get_conn)
 ):
     """
-    Obtiene todos los préstamos con paginación opcional.
+    Obtiene los préstamos con paginación por cursor (keyset).
 
     Args:
-        page (int): Número de página (por defecto 1).
+        after_id (int): ID del último préstamo de la página anterior (0 para la primera página).
         per_page (int): Número de préstamos por página (por defecto 10, máximo 100).
+        include_total (bool): Si es True también se devuelve el total de préstamos (total).
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
-        list[LoanResponse]: Una lista de todos los préstamos con paginación.
+        dict: Los préstamos de la página y el cursor de la siguiente (next_cursor).
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Obtener la página de préstamos a partir del cursor (recorre el índice de la llave primaria)
+    loans = await conn.fetch("""
+        SELECT id, user_id, book_id, loan_date, return_date, returned
+        FROM loans WHERE id > $1 ORDER BY id LIMIT $2
+    """, after_id, per_page)
 
-    # Calcular el desplazamiento para la paginación
-    offset = (page - 1) * per_page
+    # Si la página está completa puede haber más préstamos después del último ID
+    next_cursor = loans[-1]["id"] if len(loans) == per_page else None
 
-    # Obtener préstamos con paginación
-    cursor.execute("SELECT * FROM loans LIMIT %s OFFSET %s",
-                   (per_page, offset))
-    loans = cursor.fetchall()
+    # El total solo se cuenta si se pide, porque COUNT(*) recorre toda la tabla
+    total = await conn.fetchval("SELECT count(*) FROM loans") if include_total else None
 
-    return [{
-        "id": loan["id"],
-        "user_id": loan["user_id"],
-        "book_id": loan["book_id"],
-        "loan_date": loan["loan_date"],
-        "return_date": loan["return_date"],
-        "returned": loan["returned"]
-    } for loan in loans]
+    return {
+        "items": [dict(loan) for loan in loans],
+        "next_cursor": next_cursor,
+        "total": total
+    }
 
 
 @router.get("/loans/{loan_id}/", response_model=LoanResponse)
-async def get_loan(loan_id: int, token: str = Depends(oauth2_scheme)):
+async def get_loan(loan_id: int, request: Request, response: Response, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Obtiene un préstamo por su ID.
 
     Args:
         loan_id (int): El ID del préstamo a obtener.
-        token (str): El token JWT del usuario autenticado.
+        request (Request): La petición actual (para leer If-None-Match).
+        response (Response): La respuesta, donde se agrega la cabecera ETag.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles del préstamo.
@@ -193,35 +141,33 @@ async def get_loan(loan_id: int, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si el préstamo no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Obtener el préstamo por su ID
-    cursor.execute("SELECT * FROM loans WHERE id = %s", (loan_id,))
-    loan = cursor.fetchone()
+    loan = await conn.fetchrow("""
+        SELECT id, user_id, book_id, loan_date, return_date, returned
+        FROM loans
+        WHERE id = $1
+    """, loan_id)
 
     if not loan:
         raise HTTPException(status_code=404, detail="Loan not found")
 
-    return {
-        "id": loan["id"],
-        "user_id": loan["user_id"],
-        "book_id": loan["book_id"],
-        "loan_date": loan["loan_date"],
-        "return_date": loan["return_date"],
-        "returned": loan["returned"],
-        "message": "Loan retrieved successfully"
-    }
+    # Si el cliente ya tiene esta versión del préstamo se responde 304 sin cuerpo
+    etag = compute_etag(*loan.values())
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    return dict(loan)
 
 
 @router.delete("/loans/{loan_id}/", status_code=200)
-async def delete_loan(loan_id: int, token: str = Depends(oauth2_scheme)):
+async def delete_loan(loan_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Elimina un préstamo basado en su ID.
 
     Args:
         loan_id (int): El ID del préstamo a eliminar.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un mensaje de confirmación si el préstamo fue eliminado.
@@ -229,37 +175,32 @@ async def delete_loan(loan_id: int, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si el préstamo no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si el préstamo existe
-    cursor.execute("SELECT * FROM loans WHERE id = %s", (loan_id,))
-    loan = cursor.fetchone()
+    # Eliminar el préstamo; si no existe no se devuelve ningún id
+    deleted_id = await conn.fetchval(
+        "DELETE FROM loans WHERE id = $1 RETURNING id", loan_id)
 
-    if not loan:
+    if deleted_id is None:
         raise HTTPException(status_code=404, detail="Loan not found")
 
-    # Eliminar el préstamo
-    cursor.execute("DELETE FROM loans WHERE id = %s", (loan_id,))
-    conn.commit()
-
     return {"message": "Loan deleted successfully"}
 
 
 @router.get("/loans/{loan_id}/late_fee")
-async def calculate_late_fee(loan_id: int, token: str = Depends(oauth2_scheme)):
+async def calculate_late_fee(loan_id: int, request: Request, response: Response, conn: asyncpg.Connection = Depends(get_conn)):
     """
-    Calcula la multa por retraso en la devolución de un préstamo.
+    Calcula la multa por retraso en la devolución de un préstamo. La respuesta
+    lleva un ETag calculado a partir de la multa, que cambia con los días.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT calculate_late_fee(%s)", (loan_id,))
-    fee = cursor.fetchone()
+    fee = await conn.fetchval("SELECT calculate_late_fee($1)", loan_id)
 
     if fee is None:
         raise HTTPException(
             status_code=404, detail="Loan not found or no late fee applicable"
         )
 
-    return {"loan_id": loan_id, "late_fee": fee[0]}
+    etag = compute_etag(loan_id, fee)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    return {"loan_id": loan_id, "late_fee": fee}
@@ -1,24 +1,40 @@
 """endpoints de historiales de prestamos"""
-from fastapi import APIRouter, Depends, HTTPException, Query
-from app.schemas.loans_history import LoanHistoryCreate, LoanHistoryResponse
-from app.utils.database import get_db_connection
-from fastapi.security import OAuth2PasswordBearer
-from typing import List
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from app.schemas.loans_history import LoanHistoryCreate, LoanHistoryResponse, LoanHistoryPage
+from app.utils.database import get_conn, DATABASE_UNAVAILABLE_ERRORS
+from app.utils.etag import compute_etag, is_not_modified
+from datetime import datetime, timezone
+from typing import List, Optional
 
 router = APIRouter()
 
-# Esquema para autenticar a los usuarios con token JWT
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
+def _to_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """
+    Convierte una fecha con zona horaria (por ejemplo "2024-05-01T10:00:00Z") a
+    UTC sin zona, el formato de las columnas TIMESTAMP. asyncpg no acepta fechas
+    con zona en columnas sin zona; las fechas sin zona se dejan igual.
+
+    Args:
+        value (Optional[datetime]): La fecha recibida en la petición.
+
+    Returns:
+        Optional[datetime]: La fecha en UTC sin zona horaria, o None.
+    """
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
 
 
 @router.post("/loan-history/", response_model=LoanHistoryResponse)
-async def create_loan_history(loan_history: LoanHistoryCreate, token: str = Depends(oauth2_scheme)):
+async def create_loan_history(loan_history: LoanHistoryCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Crea un nuevo historial de préstamo en la base de datos.
 
     Args:
         loan_history (LoanHistoryCreate): Datos del historial de préstamo a crear.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles del historial de préstamo creado.
@@ -26,49 +42,92 @@ async def create_loan_history(loan_history: LoanHistoryCreate, token: str = Depe
     Raises:
         HTTPException: Si hay algún error en la creación.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Crear el nuevo historial de préstamo
     query = """
         INSERT INTO loan_history (user_id, book_id, loan_date, return_date, returned)
-        VALUES (%s, %s, %s, %s, %s)
+        VALUES ($1, $2, $3, $4, $5)
         RETURNING id, user_id, book_id, loan_date, return_date, returned
     """
     try:
-        cursor.execute(query, (
+        new_loan_history = await conn.fetchrow(
+            query,
             loan_history.user_id,
             loan_history.book_id,
-            loan_history.loan_date,
-            loan_history.return_date,
+            _to_naive_utc(loan_history.loan_date),
+            _to_naive_utc(loan_history.return_date),
             loan_history.returned
-        ))
-        conn.commit()
+        )
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error creating loan history: {str(e)}")
 
-    new_loan_history = cursor.fetchone()
+    return dict(new_loan_history)
 
-    return {
-        "id": new_loan_history["id"],
-        "user_id": new_loan_history["user_id"],
-        "book_id": new_loan_history["book_id"],
-        "loan_date": new_loan_history["loan_date"],
-        "return_date": new_loan_history["return_date"],
-        "returned": new_loan_history["returned"],
-        "message": "Loan history created successfully"
-    }
+
+@router.post("/loan-history/bulk", response_model=List[LoanHistoryResponse])
+async def create_loan_histories_bulk(loan_histories: List[LoanHistoryCreate], conn: asyncpg.Connection = Depends(get_conn)):
+    """
+    Crea varios historiales de préstamo en una sola operación (por ejemplo, para
+    importar o archivar historiales en lote).
+
+    Los datos viajan como arreglos y se insertan con unnest en una sola
+    sentencia, por lo que el número de viajes a la base de datos no depende de
+    la cantidad de historiales.
+
+    Args:
+        loan_histories (List[LoanHistoryCreate]): Los historiales de préstamo a crear.
+        conn (asyncpg.Connection): Conexión prestada del pool.
+
+    Returns:
+        list: Los historiales de préstamo creados, en el mismo orden en que se enviaron.
+
+    Raises:
+        HTTPException: Si hay algún error en la creación (no se crea ninguno).
+    """
+    if not loan_histories:
+        return []
+
+    # Una fecha de préstamo omitida toma la fecha actual, como el valor por defecto de la columna
+    query = """
+        INSERT INTO loan_history (user_id, book_id, loan_date, return_date, returned)
+        SELECT user_id, book_id, COALESCE(loan_date, CURRENT_TIMESTAMP), return_date, returned
+        FROM unnest($1::int[], $2::int[], $3::timestamp[], $4::timestamp[], $5::boolean[])
+            WITH ORDINALITY AS h(user_id, book_id, loan_date, return_date, returned, position)
+        ORDER BY position
+        RETURNING id, user_id, book_id, loan_date, return_date, returned
+    """
+    try:
+        new_loan_histories = await conn.fetch(
+            query,
+            [h.user_id for h in loan_histories],
+            [h.book_id for h in loan_histories],
+            [_to_naive_utc(h.loan_date) for h in loan_histories],
+            [_to_naive_utc(h.return_date) for h in loan_histories],
+            [h.returned for h in loan_histories]
+        )
+    except DATABASE_UNAVAILABLE_ERRORS:
+        # Una conexión perdida se propaga para que la app responda 503
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error creating loan histories: {str(e)}")
+
+    return [dict(loan_history) for loan_history in new_loan_histories]
 
 
 @router.get("/loan-history/{loan_history_id}/", response_model=LoanHistoryResponse)
-async def get_loan_history(loan_history_id: int, token: str = Depends(oauth2_scheme)):
+async def get_loan_history(loan_history_id: int, request: Request, response: Response, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Obtiene un historial de préstamo por su ID.
 
     Args:
         loan_history_id (int): El ID del historial de préstamo a obtener.
-        token (str): El token JWT del usuario autenticado.
+        request (Request): La petición actual (para leer If-None-Match).
+        response (Response): La respuesta, donde se agrega la cabecera ETag.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles del historial de préstamo.
@@ -76,64 +135,58 @@ async def get_loan_history(loan_history_id: int, token: str = Depends(oauth2_sch
     Raises:
         HTTPException: Si el historial no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Obtener el historial de préstamo por su ID
-    cursor.execute("SELECT * FROM loan_history WHERE id = %s",
-                   (loan_history_id,))
-    loan_history = cursor.fetchone()
+    loan_history = await conn.fetchrow("""
+        SELECT id, user_id, book_id, loan_date, return_date, returned
+        FROM loan_history
+        WHERE id = $1
+    """, loan_history_id)
 
     if not loan_history:
         raise HTTPException(status_code=404, detail="Loan history not found")
 
-    return {
-        "id": loan_history["id"],
-        "user_id": loan_history["user_id"],
-        "book_id": loan_history["book_id"],
-        "loan_date": loan_history["loan_date"],
-        "return_date": loan_history["return_date"],
-        "returned": loan_history["returned"],
-        "message": "Loan history retrieved successfully"
-    }
+    # Si el cliente ya tiene esta versión del historial se responde 304 sin cuerpo
+    etag = compute_etag(*loan_history.values())
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
 
+    return dict(loan_history)
 
-@router.get("/loan-history/", response_model=List[LoanHistoryResponse])
+
+@router.get("/loan-history/", response_model=LoanHistoryPage)
 async def list_loan_histories(
-    page: int = Query(1, ge=1),
+    after_id: int = Query(0, ge=0),
     per_page: int = Query(10, ge=1, le=100),
-    token: str = Depends(oauth2_scheme)
+    include_total: bool = Query(False),
+    conn: asyncpg.Connection = Depends(get_conn)
 ):
     """
-    Obtiene una lista de todos los historiales de préstamos en la base de datos con paginación.
+    Obtiene los historiales de préstamos con paginación por cursor (keyset).
 
     Args:
-        page (int): Número de página (por defecto 1).
+        after_id (int): ID del último historial de la página anterior (0 para la primera página).
         per_page (int): Cantidad de historiales por página (por defecto 10, máximo 100).
-        token (str): El token JWT del usuario autenticado.
+        include_total (bool): Si es True también se devuelve el total de historiales (total).
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
-        list: Una lista de todos los historiales de préstamos.
+        dict: Los historiales de la página y el cursor de la siguiente (next_cursor).
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Obtener la página de historiales a partir del cursor (recorre el índice de la llave primaria)
+    loan_histories = await conn.fetch("""
+        SELECT id, user_id, book_id, loan_date, return_date, returned
+        FROM loan_history WHERE id > $1 ORDER BY id LIMIT $2
+    """, after_id, per_page)
 
-    # Calcular el desplazamiento para la paginación
-    offset = (page - 1) * per_page
+    # Si la página está completa puede haber más historiales después del último ID
+    next_cursor = loan_histories[-1]["id"] if len(loan_histories) == per_page else None
 
-    # Obtener todos los historiales de préstamo con paginación
-    cursor.execute(
-        "SELECT * FROM loan_history LIMIT %s OFFSET %s", (per_page, offset))
-    loan_histories = cursor.fetchall()
+    # El total solo se cuenta si se pide, porque COUNT(*) recorre toda la tabla
+    total = await conn.fetchval("SELECT count(*) FROM loan_history") if include_total else None
 
-    if not loan_histories:
-        raise HTTPException(status_code=404, detail="No loan histories found")
-
-    return [{
-        "id": loan_history["id"],
-        "user_id": loan_history["user_id"],
-        "book_id": loan_history["book_id"],
-        "loan_date": loan_history["loan_date"],
-        "return_date": loan_history["return_date"],
-        "returned": loan_history["returned"]
-    } for loan_history in loan_histories]
+    return {
+        "items": [dict(loan_history) for loan_history in loan_histories],
+        "next_cursor": next_cursor,
+        "total": total
+    }
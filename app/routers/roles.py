@@ -1,24 +1,20 @@
 """endpoints de roles"""
+import asyncpg
 from fastapi import APIRouter, Depends, HTTPException, Query
-from app.schemas.role import RoleCreate, RoleResponse
-from app.utils.database import get_db_connection
-from fastapi.security import OAuth2PasswordBearer
-from typing import List
+from app.schemas.role import RoleCreate, RoleResponse, RolePage
+from app.utils.database import get_conn
 
 router = APIRouter()
 
-# Esquema para autenticar a los usuarios con token JWT
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-
 
 @router.post("/roles/", response_model=RoleResponse)
-async def create_role(role: RoleCreate, token: str = Depends(oauth2_scheme)):
+async def create_role(role: RoleCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Crea un nuevo rol en la base de datos.
 
     Args:
         role (RoleCreate): Datos del rol a crear.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles del rol creado.
@@ -26,44 +22,31 @@ async def create_role(role: RoleCreate, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si ya existe un rol con el mismo nombre.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si el rol ya existe
-    cursor.execute("SELECT * FROM roles WHERE name = %s", (role.name,))
-    existing_role = cursor.fetchone()
-
-    if existing_role:
-        raise HTTPException(
-            status_code=400, detail="Role with this name already exists"
-        )
-
-    # Crear el nuevo rol
+    # Crear el nuevo rol; si el nombre ya existe no se inserta ni se devuelve ninguna fila
     query = """
         INSERT INTO roles (name)
-        VALUES (%s)
+        VALUES ($1)
+        ON CONFLICT (name) DO NOTHING
         RETURNING id, name
     """
-    cursor.execute(query, (role.name,))
-    conn.commit()
+    new_role = await conn.fetchrow(query, role.name)
 
-    new_role = cursor.fetchone()
+    if new_role is None:
+        raise HTTPException(
+            status_code=400, detail="Role with this name already exists"
+        )
 
-    return {
-        "id": new_role["id"],
-        "name": new_role["name"],
-        "message": "Role created successfully"
-    }
+    return dict(new_role)
 
 
 @router.get("/roles/{role_id}/", response_model=RoleResponse)
-async def get_role(role_id: int, token: str = Depends(oauth2_scheme)):
+async def get_role(role_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Obtiene un rol basado en su ID.
 
     Args:
         role_id (int): El ID del rol a obtener.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles del rol.
@@ -71,32 +54,25 @@ async def get_role(role_id: int, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si el rol no existe.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Obtener el rol por su ID
-    cursor.execute("SELECT * FROM roles WHERE id = %s", (role_id,))
-    role = cursor.fetchone()
+    role = await conn.fetchrow(
+        "SELECT id, name FROM roles WHERE id = $1", role_id)
 
     if not role:
         raise HTTPException(status_code=404, detail="Role not found")
 
-    return {
-        "id": role["id"],
-        "name": role["name"],
-        "message": "Role retrieved successfully"
-    }
+    return dict(role)
 
 
 @router.put("/roles/{role_id}/", response_model=RoleResponse)
-async def update_role(role_id: int, role: RoleCreate, token: str = Depends(oauth2_scheme)):
+async def update_role(role_id: int, role: RoleCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Actualiza los detalles de un rol basado en su ID.
 
     Args:
         role_id (int): El ID del rol a editar.
         role (RoleCreate): Los nuevos datos del rol.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles actualizados del rol.
@@ -104,52 +80,34 @@ async def update_role(role_id: int, role: RoleCreate, token: str = Depends(oauth
     Raises:
         HTTPException: Si el rol no existe o si el nombre ya está en uso.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si el rol existe
-    cursor.execute("SELECT * FROM roles WHERE id = %s", (role_id,))
-    existing_role = cursor.fetchone()
-
-    if not existing_role:
-        raise HTTPException(status_code=404, detail="Role not found")
-
-    # Verificar si el nuevo nombre ya está en uso por otro rol
-    cursor.execute(
-        "SELECT * FROM roles WHERE name = %s AND id != %s", (role.name, role_id))
-    duplicate_role = cursor.fetchone()
-
-    if duplicate_role:
-        raise HTTPException(
-            status_code=400, detail="Role with this name already exists")
-
-    # Actualizar el rol
+    # Actualizar el rol; si no existe no se devuelve ninguna fila. El nombre es
+    # UNIQUE, así que un nombre en uso por otro rol lo rechaza la base de datos
     query = """
-        UPDATE roles 
-        SET name = %s 
-        WHERE id = %s 
+        UPDATE roles
+        SET name = $1
+        WHERE id = $2
         RETURNING id, name
     """
-    cursor.execute(query, (role.name, role_id))
-    conn.commit()
+    try:
+        updated_role = await conn.fetchrow(query, role.name, role_id)
+    except asyncpg.UniqueViolationError:
+        raise HTTPException(
+            status_code=400, detail="Role with this name already exists")
 
-    updated_role = cursor.fetchone()
+    if updated_role is None:
+        raise HTTPException(status_code=404, detail="Role not found")
 
-    return {
-        "id": updated_role["id"],
-        "name": updated_role["name"],
-        "message": "Role updated successfully"
-    }
+    return dict(updated_role)
 
 
 @router.delete("/roles/{role_id}/", status_code=200)
-async def delete_role(role_id: int, token: str = Depends(oauth2_scheme)):
+async def delete_role(role_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Elimina un rol basado en su ID.
 
     Args:
         role_id (int): El ID del rol a eliminar.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un mensaje de confirmación si el rol fue eliminado.
@@ -157,57 +115,53 @@ async def delete_role(role_id: int, token: str = Depends(oauth2_scheme)):
     Raises:
         HTTPException: Si el rol no existe o si está relacionado con algún usuario.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si el rol existe
-    cursor.execute("SELECT * FROM roles WHERE id = %s", (role_id,))
-    existing_role = cursor.fetchone()
-
-    if not existing_role:
-        raise HTTPException(status_code=404, detail="Role not found")
-
-    # Verificar si el rol está relacionado con algún usuario
-    cursor.execute("SELECT * FROM users WHERE role_id = %s", (role_id,))
-    related_user = cursor.fetchone()
-
-    if related_user:
+    # Eliminar el rol; si no existe no se devuelve ningún id. La llave foránea
+    # users.role_id impide borrar un rol que todavía tiene usuarios asignados
+    try:
+        deleted_id = await conn.fetchval(
+            "DELETE FROM roles WHERE id = $1 RETURNING id", role_id)
+    except asyncpg.ForeignKeyViolationError:
         raise HTTPException(
             status_code=400, detail="Cannot delete role: role is assigned to a user"
         )
 
-    # Eliminar el rol
-    cursor.execute("DELETE FROM roles WHERE id = %s", (role_id,))
-    conn.commit()
+    if deleted_id is None:
+        raise HTTPException(status_code=404, detail="Role not found")
 
     return {"message": "Role deleted successfully"}
 
 
-@router.get("/roles/", response_model=List[RoleResponse])
+@router.get("/roles/", response_model=RolePage)
 async def get_all_roles(
-    page: int = Query(1, ge=1),
+    after_id: int = Query(0, ge=0),
     per_page: int = Query(10, ge=1, le=100),
-    token: str = Depends(oauth2_scheme)
+    include_total: bool = Query(False),
+    conn: asyncpg.Connection = Depends(get_conn)
 ):
     """
-    Obtiene todos los roles con paginación opcional.
+    Obtiene los roles con paginación por cursor (keyset).
 
     Args:
-        page (int): Número de página (por defecto 1).
+        after_id (int): ID del último rol de la página anterior (0 para la primera página).
         per_page (int): Número de roles por página (por defecto 10, máximo 100).
+        include_total (bool): Si es True también se devuelve el total de roles (total).
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
-        list[RoleResponse]: Una lista de todos los roles con paginación.
+        dict: Los roles de la página y el cursor de la siguiente (next_cursor).
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Obtener la página de roles a partir del cursor (recorre el índice de la llave primaria)
+    roles = await conn.fetch(
+        "SELECT id, name FROM roles WHERE id > $1 ORDER BY id LIMIT $2", after_id, per_page)
 
-    # Calcular el desplazamiento para la paginación
-    offset = (page - 1) * per_page
+    # Si la página está completa puede haber más roles después del último ID
+    next_cursor = roles[-1]["id"] if len(roles) == per_page else None
 
-    # Obtener roles con paginación
-    cursor.execute("SELECT * FROM roles LIMIT %s OFFSET %s",
-                   (per_page, offset))
-    roles = cursor.fetchall()
+    # El total solo se cuenta si se pide, porque COUNT(*) recorre toda la tabla
+    total = await conn.fetchval("SELECT count(*) FROM roles") if include_total else None
 
-    return [{"id": role["id"], "name": role["name"]} for role in roles]
+    return {
+        "items": [dict(role) for role in roles],
+        "next_cursor": next_cursor,
+        "total": total
+    }
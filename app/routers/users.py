@@ -1,24 +1,26 @@
 """Rutas de los usuarios"""
-from fastapi import APIRouter, Depends, HTTPException, Query, status, Body
-from app.schemas.user import UserCreate, UserResponse
-from app.utils.auth import get_password_hash, verify_token
-from app.utils.database import get_db_connection
-from fastapi.security import OAuth2PasswordBearer
-from typing import List
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status, Body
+from fastapi.concurrency import run_in_threadpool
+from app.schemas.user import UserCreate, UserResponse, UserPage
+from app.utils.auth import get_password_hash
+from app.utils.database import get_conn
+from app.utils.user_cache import get_cached_user, cache_user, invalidate_user
 
-router = APIRouter()
+# El hash de bcrypt es costoso a propósito, así que se calcula en el threadpool
+# con run_in_threadpool para no bloquear el event loop.
 
-# Esquema para autenticar a los usuarios con token JWT
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+router = APIRouter()
 
 
 @router.post("/register/", response_model=UserResponse)
-async def register_user(user: UserCreate):
+async def register_user(user: UserCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Registra un nuevo usuario en la base de datos.
 
     Args:
         user (UserCreate): Datos del usuario, incluyendo username, password, email y role_id.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles del nuevo usuario (username, email, role_id).
@@ -27,147 +29,114 @@ async def register_user(user: UserCreate):
         HTTPException: Si el nombre de usuario o correo electrónico ya están registrados,
                        o si el role_id proporcionado es inválido.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Verificar si el usuario o email ya existen
-    cursor.execute("SELECT * FROM users WHERE username = %s OR email = %s",
-                   (user.username, user.email))
-    existing_user = cursor.fetchone()
+    # Hashear la contraseña del usuario
+    hashed_password = await run_in_threadpool(get_password_hash, user.password)
 
-    if existing_user:
+    # Insertar el nuevo usuario en la base de datos. Si el username o el email ya
+    # existen no se inserta ni se devuelve ninguna fila; un role_id inválido lo
+    # rechaza la llave foránea
+    query = """
+        INSERT INTO users (username, password, email, role_id)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT DO NOTHING
+        RETURNING id, username, email, role_id
+    """
+    try:
+        new_user = await conn.fetchrow(query, user.username, hashed_password,
+                                       user.email, user.role_id)
+    except asyncpg.ForeignKeyViolationError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Username or email already registered"
+            detail="Invalid role_id provided"
         )
 
-    # Verificar si el role_id es válido
-    cursor.execute("SELECT * FROM roles WHERE id = %s", (user.role_id,))
-    role = cursor.fetchone()
-
-    if not role:
+    if new_user is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid role_id provided"
+            detail="Username or email already registered"
         )
 
-    # Hashear la contraseña del usuario
-    hashed_password = get_password_hash(user.password)
-
-    # Insertar el nuevo usuario en la base de datos
-    query = """
-        INSERT INTO users (username, password, email, role_id)
-        VALUES (%s, %s, %s, %s)
-        RETURNING id, username, email, role_id
-    """
-    cursor.execute(query, (user.username, hashed_password,
-                   user.email, user.role_id))
-    conn.commit()
-
-    # Obtener los datos del nuevo usuario registrado
-    new_user = cursor.fetchone()
-
-    return {
-        "id": new_user["id"],
-        "username": new_user["username"],
-        "email": new_user["email"],
-        "role_id": new_user["role_id"]
-    }
+    return dict(new_user)
 
 
 @router.get("/users/me/")
-async def read_users_me(token: str = Depends(oauth2_scheme)):
+async def read_users_me(request: Request, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Obtiene los detalles del usuario autenticado basándose en el token JWT proporcionado.
 
     Args:
-        token (str): El token JWT del usuario autenticado.
+        request (Request): La petición actual; el middleware de autenticación deja
+            los claims del token en request.state.user.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles del usuario autenticado (username, email, role_id).
 
     Raises:
-        HTTPException: Si el token no es válido o si el usuario no existe en la base de datos.
+        HTTPException: Si el usuario no existe en la base de datos.
     """
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"}
-    )
+    # El middleware deja el ID del usuario (uid) tomado del token. Los tokens
+    # emitidos antes de agregar uid solo traen el username (sub)
+    user_id = request.state.user_id
 
-    # Verificar el token JWT y obtener el nombre de usuario
-    username = verify_token(token, credentials_exception)
-
-    # Obtener los detalles del usuario desde la base de datos
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Obtener los detalles del usuario desde la caché o, si no están, desde la base de datos
+    user = get_cached_user(user_id) if user_id is not None else None
+    if user is None:
+        if user_id is not None:
+            row = await conn.fetchrow(
+                "SELECT id, username, email, role_id FROM users WHERE id = $1", user_id)
+        else:
+            row = await conn.fetchrow(
+                "SELECT id, username, email, role_id FROM users WHERE username = $1",
+                request.state.user["sub"])
 
-    query = "SELECT * FROM users WHERE username = %s"
-    cursor.execute(query, (username,))
-    user = cursor.fetchone()
+        if row is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    if user is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        user = dict(row)
+        cache_user(user)
 
-    return {
-        "username": user["username"],
-        "email": user["email"],
-        "role_id": user["role_id"]
-    }
+    return {"username": user["username"], "email": user["email"], "role_id": user["role_id"]}
 
 
 @router.delete("/users/{user_id}/", status_code=200)
-async def delete_user(user_id: int, token: str = Depends(oauth2_scheme)):
+async def delete_user(user_id: int, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Elimina un usuario de la base de datos basado en su ID.
 
     Args:
         user_id (int): El ID del usuario a eliminar.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un mensaje de confirmación si el usuario fue eliminado exitosamente.
 
     Raises:
-        HTTPException: Si el usuario no existe o no está autorizado para eliminarlo.
+        HTTPException: Si el usuario no existe.
     """
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"}
-    )
-
-    # Verificar el token JWT
-    username = verify_token(token, credentials_exception)
-
-    # Verificar si el usuario existe
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Eliminar el usuario; si no existe no se devuelve ningún id
+    deleted_id = await conn.fetchval(
+        "DELETE FROM users WHERE id = $1 RETURNING id", user_id)
 
-    cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-    user = cursor.fetchone()
-
-    if user is None:
+    if deleted_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    # Eliminar el usuario
-    cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
-    conn.commit()
+    invalidate_user(user_id)
 
     return {"message": f"User with ID {user_id} successfully deleted."}
 
 
 @router.put("/users/{user_id}/", response_model=UserResponse)
-async def update_user(user_id: int, user: UserCreate, token: str = Depends(oauth2_scheme)):
+async def update_user(user_id: int, user: UserCreate, conn: asyncpg.Connection = Depends(get_conn)):
     """
     Edita los detalles de un usuario basado en su ID.
 
     Args:
         user_id (int): El ID del usuario a editar.
         user (UserCreate): Los nuevos datos del usuario (username, password, email, role_id).
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un objeto JSON con los detalles actualizados del usuario.
@@ -175,148 +144,123 @@ async def update_user(user_id: int, user: UserCreate, token: str = Depends(oauth
     Raises:
         HTTPException: Si el usuario no existe o los datos son inválidos.
     """
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"}
-    )
-
-    # Verificar el token JWT
-    username = verify_token(token, credentials_exception)
-
-    # Verificar si el usuario existe
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-    existing_user = cursor.fetchone()
-
-    if existing_user is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-
-    # Verificar si el nuevo username o email ya están en uso por otro usuario
-    cursor.execute("""
-        SELECT * FROM users 
-        WHERE (username = %s OR email = %s) AND id != %s
-    """, (user.username, user.email, user_id))
-    duplicate_user = cursor.fetchone()
+    # Hashear la nueva contraseña
+    hashed_password = await run_in_threadpool(get_password_hash, user.password)
 
-    if duplicate_user:
+    # Actualizar los datos del usuario; si no existe no se devuelve ninguna fila.
+    # El username y el email son UNIQUE, así que los valores en uso por otro
+    # usuario los rechaza la base de datos, igual que un role_id inválido
+    query = """
+        UPDATE users
+        SET username = $1, password = $2, email = $3, role_id = $4, updated_at = CURRENT_TIMESTAMP
+        WHERE id = $5
+        RETURNING id, username, email, role_id
+    """
+    try:
+        updated_user = await conn.fetchrow(query, user.username, hashed_password,
+                                           user.email, user.role_id, user_id)
+    except asyncpg.UniqueViolationError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username or email already in use"
         )
+    except asyncpg.ForeignKeyViolationError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid role_id provided"
+        )
 
-    # Hashear la nueva contraseña
-    hashed_password = get_password_hash(user.password)
-
-    # Actualizar los datos del usuario
-    query = """
-        UPDATE users 
-        SET username = %s, password = %s, email = %s, role_id = %s, updated_at = CURRENT_TIMESTAMP
-        WHERE id = %s 
-        RETURNING id, username, email, role_id
-    """
-    cursor.execute(query, (user.username, hashed_password,
-                   user.email, user.role_id, user_id))
-    conn.commit()
+    if updated_user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    updated_user = cursor.fetchone()
+    invalidate_user(user_id)
 
-    return {
-        "id": updated_user["id"],
-        "username": updated_user["username"],
-        "email": updated_user["email"],
-        "role_id": updated_user["role_id"]
-    }
+    return dict(updated_user)
 
 
-@router.get("/users/", response_model=List[UserResponse])
+@router.get("/users/", response_model=UserPage)
 async def list_users(
-    page: int = Query(1, ge=1),
+    after_id: int = Query(0, ge=0),
     per_page: int = Query(10, ge=1, le=100),
+    include_total: bool = Query(False),
     username: str = None,
     user_id: int = None,  # Nuevo parámetro para filtrar por ID
-    token: str = Depends(oauth2_scheme)
+    conn: asyncpg.Connection = Depends(get_conn)
 ):
     """
-    Obtiene la lista de todos los usuarios con paginación y filtros.
+    Obtiene los usuarios con paginación por cursor (keyset) y filtros.
 
     Args:
-        page (int): Número de página.
+        after_id (int): ID del último usuario de la página anterior (0 para la primera página).
         per_page (int): Cantidad de resultados por página (máximo 100).
+        include_total (bool): Si es True también se devuelve el total de usuarios
+            que cumplen los filtros (total).
         username (str, opcional): Filtro por nombre de usuario.
         user_id (int, opcional): Filtro por ID de usuario.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
-        list[UserResponse]: Una lista de usuarios con sus detalles, incluyendo el ID.
-
-    Raises:
-        HTTPException: Si no se puede validar el token.
+        dict: Los usuarios de la página y el cursor de la siguiente (next_cursor).
     """
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"}
-    )
-
-    # Verificar el token JWT
-    verify_token(token, credentials_exception)
-
-    # Obtener la conexión a la base de datos
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Filtro opcional por username o user_id
-    query = "SELECT id, username, email, role_id FROM users WHERE TRUE"
+    # Filtro opcional por username o user_id. La búsqueda por username usa el
+    # índice trigram de users.username, así que ILIKE no recorre toda la tabla
+    filters = ""
     params = []
 
     if username:
-        query += " AND username ILIKE %s"
         params.append(f"%{username}%")
+        filters += f" AND username ILIKE ${len(params)}"
 
     if user_id:
-        query += " AND id = %s"
         params.append(user_id)
+        filters += f" AND id = ${len(params)}"
 
-    # Paginación
-    offset = (page - 1) * per_page
-    query += " LIMIT %s OFFSET %s"
-    params.extend([per_page, offset])
+    # Obtener la página de usuarios a partir del cursor (recorre el índice de la llave primaria)
+    query = (
+        "SELECT id, username, email, role_id FROM users"
+        f" WHERE id > ${len(params) + 1}{filters}"
+        f" ORDER BY id LIMIT ${len(params) + 2}"
+    )
+    users = await conn.fetch(query, *params, after_id, per_page)
 
-    cursor.execute(query, tuple(params))
-    users = cursor.fetchall()
+    # Si la página está completa puede haber más usuarios después del último ID
+    next_cursor = users[-1]["id"] if len(users) == per_page else None
 
-    return [{"id": user["id"], "username": user["username"], "email": user["email"], "role_id": user["role_id"]} for user in users]
+    # El total solo se cuenta si se pide, porque COUNT(*) recorre toda la tabla
+    total = None
+    if include_total:
+        total = await conn.fetchval(f"SELECT count(*) FROM users WHERE TRUE{filters}", *params)
+
+    return {
+        "items": [dict(user) for user in users],
+        "next_cursor": next_cursor,
+        "total": total
+    }
 
 
 @router.get("/users/{user_id}/", response_model=UserResponse)
 async def get_user_by_id(
     user_id: int,
-    token: str = Depends(oauth2_scheme)
+    conn: asyncpg.Connection = Depends(get_conn)
 ):
     """
     Obtiene los detalles de un usuario específico por ID.
     """
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    verify_token(token, credentials_exception)
+    user = get_cached_user(user_id)
+    if user is not None:
+        return user
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    row = await conn.fetchrow(
+        "SELECT id, username, email, role_id FROM users WHERE id = $1", user_id)
 
-    cursor.execute(
-        "SELECT id, username, email, role_id FROM users WHERE id = %s", (user_id,))
-    user = cursor.fetchone()
-
-    if not user:
+    if not row:
         raise HTTPException(status_code=404, detail="User not found")
 
-    return {"id": user["id"], "username": user["username"], "email": user["email"], "role_id": user["role_id"]}
+    user = dict(row)
+    cache_user(user)
+
+    return user
 
 
 @router.put("/users/{user_id}/update-password/")
@@ -324,7 +268,7 @@ async def update_password(
     user_id: int,
     # Recibe `new_password` directamente del cuerpo de la solicitud
     new_password: str = Body(..., embed=True),
-    token: str = Depends(oauth2_scheme)
+    conn: asyncpg.Connection = Depends(get_conn)
 ):
     """
     Permite a un administrador o usuario cambiar la contraseña de un usuario específico usando el ID.
@@ -332,7 +276,7 @@ async def update_password(
     Args:
         user_id (int): El ID del usuario cuyo password se va a cambiar.
         new_password (str): La nueva contraseña deseada.
-        token (str): El token JWT del usuario autenticado.
+        conn (asyncpg.Connection): Conexión prestada del pool.
 
     Returns:
         dict: Un mensaje de éxito si la contraseña fue cambiada correctamente.
@@ -340,37 +284,18 @@ async def update_password(
     Raises:
         HTTPException: Si ocurre un error durante el cambio de contraseña.
     """
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"}
-    )
-
-    # Verificar el token JWT
-    verify_token(token, credentials_exception)
-
-    # Obtener la conexión a la base de datos
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Hashear la nueva contraseña
+    hashed_new_password = await run_in_threadpool(get_password_hash, new_password)
 
-    # Verificar si el usuario cuyo ID fue pasado existe
-    cursor.execute("SELECT id FROM users WHERE id = %s", (user_id,))
-    user = cursor.fetchone()
+    # Actualizar la contraseña del usuario con el ID proporcionado; si no existe no se devuelve ningún id
+    updated_id = await conn.fetchval(
+        "UPDATE users SET password = $1, updated_at = CURRENT_TIMESTAMP WHERE id = $2 RETURNING id",
+        hashed_new_password, user_id)
 
-    if not user:
+    if updated_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
 
-    # Hashear la nueva contraseña
-    hashed_new_password = get_password_hash(new_password)
-
-    # Actualizar la contraseña en la base de datos para el usuario con el ID proporcionado
-    cursor.execute(
-        "UPDATE users SET password = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-        (hashed_new_password, user["id"])
-    )
-    conn.commit()
-
     return {"message": "Password updated successfully"}
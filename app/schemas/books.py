@@ -1,6 +1,6 @@
 """Modelo de libros."""
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 
@@ -71,3 +71,18 @@ class BookResponse(BaseModel):
     copies_available: int
     created_at: datetime
     updated_at: datetime
+
+
+class BookPage(BaseModel):
+    """
+    Esquema de respuesta para una página de libros (paginación por cursor).
+
+    Atributos:
+        items (List[BookResponse]): Los libros de la página.
+        next_cursor (Optional[int]): El ID a enviar como after_id para pedir la
+            siguiente página, o None si ya no hay más libros.
+        total (Optional[int]): El total de libros; solo se calcula con include_total=true.
+    """
+    items: List[BookResponse]
+    next_cursor: Optional[int] = None
+    total: Optional[int] = None
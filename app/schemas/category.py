@@ -1,5 +1,6 @@
 """Categorias de libros."""
 from pydantic import BaseModel
+from typing import List, Optional
 
 
 class CategoryBase(BaseModel):
@@ -31,3 +32,18 @@ class CategoryResponse(BaseModel):
     """
     id: int
     name: str
+
+
+class CategoryPage(BaseModel):
+    """
+    Esquema de respuesta para una página de categorías (paginación por cursor).
+
+    Atributos:
+        items (List[CategoryResponse]): Las categorías de la página.
+        next_cursor (Optional[int]): El ID a enviar como after_id para pedir la
+            siguiente página, o None si ya no hay más categorías.
+        total (Optional[int]): El total de categorías; solo se calcula con include_total=true.
+    """
+    items: List[CategoryResponse]
+    next_cursor: Optional[int] = None
+    total: Optional[int] = None
@@ -1,6 +1,6 @@
 """Modelo de multas"""
 from pydantic import BaseModel, condecimal
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 
@@ -43,3 +43,18 @@ class FineResponse(BaseModel):
 
     class Config:
         orm_mode = True  # Permitir que funcione con datos provenientes de la base de datos
+
+
+class FinePage(BaseModel):
+    """
+    Esquema de respuesta para una página de multas (paginación por cursor).
+
+    Atributos:
+        items (List[FineResponse]): Las multas de la página.
+        next_cursor (Optional[int]): El ID a enviar como after_id para pedir la
+            siguiente página, o None si ya no hay más multas.
+        total (Optional[int]): El total de multas; solo se calcula con include_total=true.
+    """
+    items: List[FineResponse]
+    next_cursor: Optional[int] = None
+    total: Optional[int] = None
@@ -1,5 +0,0 @@
-from pydantic import BaseModel
-
-
-class InvalidatedToken(BaseModel):
-    token: str
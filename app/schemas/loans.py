@@ -1,6 +1,6 @@
 """Modelo de prestamos"""
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 
@@ -38,3 +38,18 @@ class LoanResponse(BaseModel):
     class Config:
         # Esto permite trabajar con datos de la base de datos como objetos de Pydantic
         orm_mode = True
+
+
+class LoanPage(BaseModel):
+    """
+    Esquema de respuesta para una página de préstamos (paginación por cursor).
+
+    Atributos:
+        items (List[LoanResponse]): Los préstamos de la página.
+        next_cursor (Optional[int]): El ID a enviar como after_id para pedir la
+            siguiente página, o None si ya no hay más préstamos.
+        total (Optional[int]): El total de préstamos; solo se calcula con include_total=true.
+    """
+    items: List[LoanResponse]
+    next_cursor: Optional[int] = None
+    total: Optional[int] = None
@@ -1,6 +1,6 @@
 """Modelo Historial de prestamos"""
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 
@@ -43,3 +43,18 @@ class LoanHistoryResponse(BaseModel):
 
     class Config:
         orm_mode = True  # Permitir que funcione con datos provenientes de la base de datos
+
+
+class LoanHistoryPage(BaseModel):
+    """
+    Esquema de respuesta para una página de historiales de préstamo (paginación por cursor).
+
+    Atributos:
+        items (List[LoanHistoryResponse]): Los historiales de la página.
+        next_cursor (Optional[int]): El ID a enviar como after_id para pedir la
+            siguiente página, o None si ya no hay más historiales.
+        total (Optional[int]): El total de historiales; solo se calcula con include_total=true.
+    """
+    items: List[LoanHistoryResponse]
+    next_cursor: Optional[int] = None
+    total: Optional[int] = None
@@ -1,5 +1,6 @@
 """Modelo de rol"""
 from pydantic import BaseModel
+from typing import List, Optional
 
 
 class RoleBase(BaseModel):
@@ -31,3 +32,18 @@ class RoleResponse(BaseModel):
     """
     id: int
     name: str
+
+
+class RolePage(BaseModel):
+    """
+    Esquema de respuesta para una página de roles (paginación por cursor).
+
+    Atributos:
+        items (List[RoleResponse]): Los roles de la página.
+        next_cursor (Optional[int]): El ID a enviar como after_id para pedir la
+            siguiente página, o None si ya no hay más roles.
+        total (Optional[int]): El total de roles; solo se calcula con include_total=true.
+    """
+    items: List[RoleResponse]
+    next_cursor: Optional[int] = None
+    total: Optional[int] = None
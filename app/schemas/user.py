@@ -1,5 +1,6 @@
 """Modelos para usuarios"""
 from pydantic import BaseModel
+from typing import List, Optional
 
 
 class UserCreate(BaseModel):
@@ -33,3 +34,19 @@ class UserResponse(BaseModel):
     username: str
     email: str
     role_id: int
+
+
+class UserPage(BaseModel):
+    """
+    Esquema de respuesta para una página de usuarios (paginación por cursor).
+
+    Atributos:
+        items (List[UserResponse]): Los usuarios de la página.
+        next_cursor (Optional[int]): El ID a enviar como after_id para pedir la
+            siguiente página, o None si ya no hay más usuarios.
+        total (Optional[int]): El total de usuarios que cumplen los filtros; solo
+            se calcula con include_total=true.
+    """
+    items: List[UserResponse]
+    next_cursor: Optional[int] = None
+    total: Optional[int] = None
@@ -1,7 +1,8 @@
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+import bcrypt
+from jose import jwk, jwt
 from datetime import datetime, timedelta, timezone
 import os
+from uuid import uuid4
 from dotenv import load_dotenv
 
 # Cargar las variables de entorno desde el archivo .env
@@ -10,10 +11,18 @@ load_dotenv()
 # Clave secreta para firmar los tokens (debería almacenarse en variables de entorno)
 SECRET_KEY = os.getenv("SECRET_KEY", "secret_jwt_key")
 ALGORITHM = "HS256"
+# Llave de firma construida una sola vez. Con la clave como texto, python-jose
+# intenta interpretarla como JWK y construye el objeto de la llave en cada
+# firma y en cada verificación.
+SIGNING_KEY = jwk.construct(SECRET_KEY, ALGORITHM)
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Hasher de contraseñas usando bcrypt
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Costo de bcrypt para los hashes nuevos (por defecto 2^12 iteraciones, el mismo
+# que usaba passlib). Cada hash guarda su propio costo, así que cambiarlo no
+# invalida las contraseñas ya registradas; solo afecta a las que se hashean después.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# bcrypt solo considera los primeros 72 bytes de la contraseña
+BCRYPT_MAX_BYTES = 72
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -27,7 +36,10 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     Returns:
         bool: True si la contraseña coincide, de lo contrario False.
     """
-    return pwd_context.verify(plain_password, hashed_password)
+    return bcrypt.checkpw(
+        plain_password.encode("utf-8")[:BCRYPT_MAX_BYTES],
+        hashed_password.encode("utf-8"),
+    )
 
 
 def get_password_hash(password: str) -> str:
@@ -40,7 +52,8 @@ def get_password_hash(password: str) -> str:
     Returns:
         str: La contraseña hasheada.
     """
-    return pwd_context.hash(password)
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    return bcrypt.hashpw(password.encode("utf-8")[:BCRYPT_MAX_BYTES], salt).decode("utf-8")
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
@@ -62,30 +75,8 @@ def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
     else:
         expire = datetime.now(timezone.utc) + \
             timedelta(minutes=15)  # Expiración por defecto
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    # jti identifica al token de forma única para poder invalidarlo en el logout
+    to_encode.update({"exp": expire, "jti": uuid4().hex})
+    encoded_jwt = jwt.encode(to_encode, SIGNING_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-
-def verify_token(token: str, credentials_exception):
-    """
-    Verifica la validez de un token JWT. Decodifica el token y extrae el nombre de usuario.
-
-    Args:
-        token (str): El token JWT proporcionado por el cliente.
-        credentials_exception: La excepción a levantar si la verificación falla.
-
-    Returns:
-        str: El nombre de usuario (sub) contenido en el token, si es válido.
-
-    Raises:
-        HTTPException: Si el token es inválido o ha expirado.
-    """
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        return username
-    except JWTError:
-        raise credentials_exception
@@ -0,0 +1,45 @@
+"""Caché de disponibilidad de libros"""
+from typing import Optional
+from cachetools import TTLCache
+
+# Vida de cada entrada (en segundos). Es corta para que nadie vea un inventario
+# desactualizado: basta para absorber las consultas repetidas del catálogo.
+AVAILABILITY_TTL_SECONDS = 2
+
+# Copias disponibles por ID de libro
+_availability = TTLCache(maxsize=10_000, ttl=AVAILABILITY_TTL_SECONDS)
+
+
+def get_cached_availability(book_id: int) -> Optional[int]:
+    """
+    Obtiene las copias disponibles de un libro si están en caché.
+
+    Args:
+        book_id (int): El ID del libro.
+
+    Returns:
+        Optional[int]: Las copias disponibles, o None si no están en caché.
+    """
+    return _availability.get(book_id)
+
+
+def cache_availability(book_id: int, available_copies: int) -> None:
+    """
+    Guarda en caché las copias disponibles de un libro.
+
+    Args:
+        book_id (int): El ID del libro.
+        available_copies (int): Las copias disponibles.
+    """
+    _availability[book_id] = available_copies
+
+
+def invalidate_availability(book_id: int) -> None:
+    """
+    Descarta la disponibilidad en caché de un libro. Se llama desde cada
+    endpoint que modifica copies_available.
+
+    Args:
+        book_id (int): El ID del libro.
+    """
+    _availability.pop(book_id, None)
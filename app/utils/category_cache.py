@@ -0,0 +1,45 @@
+"""Caché de categorías"""
+from typing import Optional
+from cachetools import TTLCache
+
+# Vida de cada entrada (en segundos). Las categorías casi no cambian y los
+# cambios hechos en este proceso invalidan la caché al momento; el TTL solo
+# acota lo que tarda en verse un cambio hecho por otro proceso.
+CATEGORY_TTL_SECONDS = 60
+
+# Categorías por ID. Solo sirve para lecturas: si un nombre está en uso lo
+# decide siempre la base de datos, porque la caché puede estar desactualizada
+_categories_by_id = TTLCache(maxsize=1024, ttl=CATEGORY_TTL_SECONDS)
+
+
+def get_cached_category(category_id: int) -> Optional[dict]:
+    """
+    Obtiene una categoría si está en caché.
+
+    Args:
+        category_id (int): El ID de la categoría.
+
+    Returns:
+        Optional[dict]: La categoría (id y name), o None si no está en caché.
+    """
+    return _categories_by_id.get(category_id)
+
+
+def cache_category(category: dict) -> None:
+    """
+    Guarda en caché una categoría bajo su ID.
+
+    Args:
+        category (dict): La categoría (id y name).
+    """
+    _categories_by_id[category["id"]] = category
+
+
+def invalidate_category(category_id: int) -> None:
+    """
+    Descarta una categoría de la caché. Se llama al actualizarla o eliminarla.
+
+    Args:
+        category_id (int): El ID de la categoría.
+    """
+    _categories_by_id.pop(category_id, None)
@@ -1,12 +1,17 @@
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from fastapi import HTTPException
+import asyncio
+import asyncpg
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 
 # Cargar las variables de entorno desde el archivo .env
 load_dotenv()
 
+# Variables de entorno sin las que no se puede conectar a la base de datos
+REQUIRED_ENV_VARS = ("DATABASE_USER", "DATABASE_PASSWORD", "DATABASE_HOST", "DATABASE_PORT", "DATABASE_NAME")
+
 # Cargar la configuración de la base de datos desde variables de entorno
 DB_USER = os.getenv("DATABASE_USER")
 DB_PASSWORD = os.getenv("DATABASE_PASSWORD")
@@ -14,25 +19,140 @@ DB_HOST = os.getenv("DATABASE_HOST")
 DB_PORT = os.getenv("DATABASE_PORT")
 DB_NAME = os.getenv("DATABASE_NAME")
 
-# Construir la URL de conexión a la base de datos
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Parámetros de conexión a la base de datos. Se pasan por separado en lugar de
+# armar una URL, así asyncpg no tiene que interpretar un DSN cada vez que el pool
+# abre una conexión y una contraseña con caracteres como @, / o : no rompe la URL.
+CONNECT_KWARGS = {
+    "user": DB_USER,
+    "password": DB_PASSWORD,
+    "host": DB_HOST,
+    "port": DB_PORT,
+    "database": DB_NAME,
+}
+
+# Tamaño del pool de conexiones asíncronas. Detrás de PgBouncer conviene un
+# pool pequeño, ya que es PgBouncer quien reparte las conexiones reales.
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "10"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+# Tiempo máximo (en segundos) que puede tardar una consulta
+COMMAND_TIMEOUT = 30
+# Parámetros de sesión que se envían al abrir cada conexión (una vez por
+# conexión, no por petición). application_name identifica las conexiones de la
+# api en pg_stat_activity; PgBouncer también lo acepta como parámetro de inicio.
+SERVER_SETTINGS = {"application_name": "libsoma"}
+# Tiempo máximo (en segundos) para abrir una conexión nueva; con un host
+# equivocado o caído el intento falla pronto en lugar de ocupar al worker
+CONNECT_TIMEOUT = 5
+# Sentencias preparadas que asyncpg conserva por conexión. Cada texto SQL se
+# prepara (parse + plan) la primera vez y luego se reutiliza, por lo que las
+# consultas frecuentes (login, libro o reserva por ID) no se vuelven a analizar.
+# Con PgBouncer en modo transaction debe ser 0, porque una sentencia preparada
+# en una conexión del servidor no existe en las demás.
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "1024"))
+# Tiempo máximo (en segundos) que una petición espera por una conexión libre
+ACQUIRE_TIMEOUT = 5.0
 
 
-def get_db_connection():
+async def create_db_pool() -> asyncpg.Pool:
     """
-    Crear y devolver una conexión a la base de datos PostgreSQL.
+    Crear el pool de conexiones asíncronas a la base de datos PostgreSQL.
+
+    Se crea una sola vez al iniciar la aplicación, de modo que cada petición
+    reutiliza una conexión ya autenticada en lugar de abrir una nueva.
 
     Returns:
-        psycopg2.extensions.connection: La conexión a la base de datos.
+        asyncpg.Pool: El pool de conexiones.
+
     Raises:
-        HTTPException: Si ocurre un error al intentar conectarse a la base de datos.
+        RuntimeError: Si falta alguna de las variables de entorno de la base de datos.
     """
+    # Fallar al arrancar, y no en la primera petición, si la configuración está incompleta
+    missing = [name for name in REQUIRED_ENV_VARS if os.getenv(name) is None]
+    if missing:
+        raise RuntimeError(f"Missing database environment variables: {', '.join(missing)}")
+
+    return await asyncpg.create_pool(
+        **CONNECT_KWARGS,
+        timeout=CONNECT_TIMEOUT,
+        server_settings=SERVER_SETTINGS,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        command_timeout=COMMAND_TIMEOUT,
+        statement_cache_size=STATEMENT_CACHE_SIZE,
+    )
+
+
+@asynccontextmanager
+async def acquire_conn(pool: asyncpg.Pool):
+    """
+    Presta una conexión del pool y la devuelve al salir del bloque.
+
+    Si el pool está agotado se espera como máximo ACQUIRE_TIMEOUT segundos en
+    lugar de quedarse colgado. Es la única forma de pedir conexiones en la api:
+    la usan get_conn y los endpoints que solo consultan la base de datos a veces.
+
+    Args:
+        pool (asyncpg.Pool): El pool de la aplicación (app.state.pool).
+
+    Yields:
+        asyncpg.Connection: Una conexión del pool.
+
+    Raises:
+        HTTPException: Si no se obtiene una conexión a tiempo (503).
+    """
+    try:
+        conn = await pool.acquire(timeout=ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError as e:
+        raise HTTPException(status_code=503, detail="Database is saturated, try again later") from e
+
     try:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-        return conn
-    except Exception as e:
-        # Manejar errores de conexión a la base de datos y preservar la excepción original
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error connecting to the database: {str(e)}"
-        ) from e
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+async def get_conn(request: Request):
+    """
+    Dependencia de FastAPI que presta una conexión del pool durante la petición.
+
+    La conexión se devuelve al pool automáticamente al terminar la petición. Cada
+    endpoint usa una sola conexión por petición (ver acquire_conn).
+
+    Args:
+        request (Request): La petición actual, usada para acceder al pool de la aplicación.
+
+    Yields:
+        asyncpg.Connection: Una conexión del pool.
+    Raises:
+        HTTPException: Si no se obtiene una conexión a tiempo (503).
+    """
+    async with acquire_conn(request.app.state.pool) as conn:
+        yield conn
+
+
+# Errores que indican que la base de datos no está disponible: el servidor
+# rechaza o corta la conexión, o la conexión prestada ya se cerró
+DATABASE_UNAVAILABLE_ERRORS = (
+    asyncpg.PostgresConnectionError,
+    asyncpg.ConnectionDoesNotExistError,
+    ConnectionError,
+)
+
+
+async def database_unavailable_handler(request: Request, exc: Exception) -> JSONResponse:
+    """
+    Manejador de excepciones de la aplicación para los errores de conexión con
+    la base de datos. Se registra una sola vez en la app, de modo que ni
+    get_conn ni los endpoints tienen que traducir estos errores.
+
+    Args:
+        request (Request): La petición que falló.
+        exc (Exception): El error de conexión.
+
+    Returns:
+        JSONResponse: Una respuesta 503 para que el cliente reintente más tarde.
+    """
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Database is unavailable, try again later"},
+    )
@@ -0,0 +1,38 @@
+"""ETags para respuestas de solo lectura"""
+import hashlib
+from fastapi import Request
+
+
+def compute_etag(*values) -> str:
+    """
+    Calcula un ETag fuerte a partir del contenido de una respuesta.
+
+    Args:
+        *values: Los valores que determinan la respuesta (por ejemplo, las columnas de la fila).
+
+    Returns:
+        str: El ETag entre comillas, listo para la cabecera ETag.
+    """
+    digest = hashlib.blake2b(repr(values).encode("utf-8"), digest_size=8).hexdigest()
+    return f'"{digest}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """
+    Indica si el cliente ya tiene la versión actual de la respuesta, según su
+    cabecera If-None-Match.
+
+    Args:
+        request (Request): La petición actual.
+        etag (str): El ETag de la respuesta actual.
+
+    Returns:
+        bool: True si se puede responder 304 Not Modified, de lo contrario False.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # La cabecera puede traer varios ETags separados por comas (y débiles, con W/)
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
@@ -0,0 +1,76 @@
+"""Recálculo periódico de multas por retraso"""
+import asyncio
+import logging
+import os
+import asyncpg
+
+logger = logging.getLogger("uvicorn.error")
+
+# Parámetros de la multa
+INITIAL_FINE = 100  # Multa inicial después del período de gracia
+DAILY_FINE = 10  # Multa diaria adicional por cada día después del período de gracia
+GRACE_PERIOD_DAYS = 7  # Días de gracia sin multa
+
+# Cada cuántos segundos se recalculan las multas (por defecto cada 5 minutos)
+FINE_RECOMPUTE_INTERVAL_SECONDS = int(os.getenv("FINE_RECOMPUTE_INTERVAL_SECONDS", "300"))
+
+# Llave del advisory lock que evita que varios procesos recalculen a la vez
+FINE_RECOMPUTE_LOCK_KEY = 72_001
+
+
+async def recalculate_overdue_fines(conn: asyncpg.Connection) -> bool:
+    """
+    Crea o recalcula la multa de cada préstamo vencido que no ha sido devuelto.
+
+    Se ejecuta como un solo UPSERT (una multa pendiente por préstamo). Si otro
+    proceso ya está recalculando, no hace nada.
+
+    Args:
+        conn (asyncpg.Connection): Conexión a la base de datos.
+
+    Returns:
+        bool: True si se recalcularon las multas, False si otro proceso lo estaba haciendo.
+    """
+    async with conn.transaction():
+        if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", FINE_RECOMPUTE_LOCK_KEY):
+            return False
+
+        await conn.execute("""
+            WITH overdue AS (
+                SELECT id, user_id,
+                       date_part('day', LOCALTIMESTAMP - loan_date)::int - $3 AS overdue_days
+                FROM loans
+                WHERE returned = FALSE
+            )
+            INSERT INTO fines (user_id, loan_id, amount, description, paid, fine_date)
+            SELECT user_id, id, $1 + overdue_days * $2,
+                   'Multa por exceso de días (' || overdue_days || ' días excedidos)',
+                   FALSE, LOCALTIMESTAMP
+            FROM overdue
+            WHERE overdue_days > 0
+            ON CONFLICT (loan_id) WHERE paid = FALSE
+            DO UPDATE SET amount = EXCLUDED.amount,
+                          description = EXCLUDED.description,
+                          fine_date = EXCLUDED.fine_date
+        """, INITIAL_FINE, DAILY_FINE, GRACE_PERIOD_DAYS)
+
+    return True
+
+
+async def fine_recompute_loop(pool: asyncpg.Pool) -> None:
+    """
+    Tarea en segundo plano que recalcula las multas al iniciar la aplicación y
+    luego cada FINE_RECOMPUTE_INTERVAL_SECONDS. Un error en una ronda se registra
+    y no detiene la tarea.
+
+    Args:
+        pool (asyncpg.Pool): El pool de conexiones de la aplicación.
+    """
+    while True:
+        try:
+            async with pool.acquire() as conn:
+                await recalculate_overdue_fines(conn)
+        except Exception:
+            logger.exception("Error recalculating overdue fines")
+
+        await asyncio.sleep(FINE_RECOMPUTE_INTERVAL_SECONDS)
@@ -0,0 +1,41 @@
+"""Caché de verificación de tokens JWT"""
+import hashlib
+import time
+from cachetools import TTLCache
+from jose import jwt
+from app.utils.auth import SIGNING_KEY, ALGORITHM
+
+# Tiempo (en segundos) que se reutilizan los claims de un token ya verificado
+JWT_CACHE_TTL_SECONDS = 10
+
+# Claims verificados por hash del token, junto con el instante en que dejan de ser válidos
+_verified_tokens = TTLCache(maxsize=10_000, ttl=JWT_CACHE_TTL_SECONDS)
+
+
+def verify_cached(token: str) -> dict:
+    """
+    Verifica un token JWT reutilizando el resultado de verificaciones recientes.
+
+    Un token que llega varias veces en pocos segundos solo se decodifica y se
+    verifica la primera vez. Los tokens inválidos nunca se guardan en caché y una
+    entrada no sobrevive a la expiración (exp) del propio token.
+
+    Args:
+        token (str): El token JWT proporcionado por el cliente.
+
+    Returns:
+        dict: Los claims del token.
+
+    Raises:
+        JWTError: Si el token es inválido o ha expirado.
+    """
+    key = hashlib.sha256(token.encode("utf-8")).digest()
+    now = time.time()
+
+    cached = _verified_tokens.get(key)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    claims = jwt.decode(token, SIGNING_KEY, algorithms=[ALGORITHM])
+    _verified_tokens[key] = (claims, min(claims.get("exp", now), now + JWT_CACHE_TTL_SECONDS))
+    return claims
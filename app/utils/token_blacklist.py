@@ -0,0 +1,51 @@
+"""Lista negra de tokens invalidados"""
+import os
+import time
+import redis.asyncio as redis
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+# Cargar las variables de entorno desde el archivo .env
+load_dotenv()
+
+# Vida máxima de un token emitido por /token/ (360 minutos)
+MAX_TOKEN_TTL_SECONDS = 360 * 60
+
+# Si se define REDIS_URL la lista negra se comparte entre procesos mediante Redis;
+# de lo contrario se guarda en memoria (válido para un solo proceso).
+REDIS_URL = os.getenv("REDIS_URL")
+_redis = redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# Las entradas caducan solas cuando el token ya habría expirado, por lo que la
+# memoria queda acotada sin necesidad de una limpieza manual.
+_local_blacklist = TTLCache(maxsize=100_000, ttl=MAX_TOKEN_TTL_SECONDS)
+
+
+async def invalidate_token(jti: str, expires_at: int) -> None:
+    """
+    Agrega el identificador (jti) de un token a la lista negra hasta que expire.
+
+    Args:
+        jti (str): El identificador único del token.
+        expires_at (int): El instante de expiración del token (claim exp, en segundos).
+    """
+    if _redis is not None:
+        ttl = max(int(expires_at - time.time()), 1)
+        await _redis.set(f"bl:{jti}", 1, ex=ttl)
+    else:
+        _local_blacklist[jti] = True
+
+
+async def is_token_invalidated(jti: str) -> bool:
+    """
+    Verifica si el token está en la lista negra (invalidado).
+
+    Args:
+        jti (str): El identificador único del token.
+
+    Returns:
+        bool: True si el token fue invalidado, de lo contrario False.
+    """
+    if _redis is not None:
+        return bool(await _redis.exists(f"bl:{jti}"))
+    return jti in _local_blacklist
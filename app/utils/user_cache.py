@@ -0,0 +1,44 @@
+"""Caché de usuarios"""
+from typing import Optional
+from cachetools import TTLCache
+
+# Vida de cada entrada (en segundos). Los endpoints que modifican un usuario
+# descartan su entrada, así que el TTL solo acota cambios hechos fuera de la API.
+USER_TTL_SECONDS = 60
+
+# Datos públicos del usuario (id, username, email, role_id) por ID
+_users = TTLCache(maxsize=5000, ttl=USER_TTL_SECONDS)
+
+
+def get_cached_user(user_id: int) -> Optional[dict]:
+    """
+    Obtiene un usuario si está en caché.
+
+    Args:
+        user_id (int): El ID del usuario.
+
+    Returns:
+        Optional[dict]: El usuario (id, username, email, role_id), o None si no está en caché.
+    """
+    return _users.get(user_id)
+
+
+def cache_user(user: dict) -> None:
+    """
+    Guarda un usuario en caché. Nunca debe incluir la contraseña.
+
+    Args:
+        user (dict): El usuario con sus columnas id, username, email y role_id.
+    """
+    _users[user["id"]] = user
+
+
+def invalidate_user(user_id: int) -> None:
+    """
+    Descarta un usuario de la caché. Se llama desde cada endpoint que modifica
+    o elimina un usuario.
+
+    Args:
+        user_id (int): El ID del usuario.
+    """
+    _users.pop(user_id, None)
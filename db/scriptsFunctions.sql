@@ -101,6 +101,93 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Función para crear una reserva y devolver la reserva creada
+CREATE OR REPLACE FUNCTION reserve_book_v2(p_user_id INTEGER, p_book_id INTEGER) RETURNS SETOF book_reservations AS $$
+DECLARE
+    copy_taken BOOLEAN;
+BEGIN
+    -- Disminuir el número de copias disponibles; la fila del libro queda bloqueada
+    -- hasta el final de la transacción, lo que serializa las reservas del mismo libro
+    UPDATE books
+    SET copies_available = copies_available - 1
+    WHERE id = p_book_id AND copies_available > 0;
+    copy_taken := FOUND;
+
+    -- Verificar que el usuario no tenga ya una reserva activa del libro
+    IF EXISTS (SELECT 1 FROM book_reservations
+               WHERE user_id = p_user_id AND book_id = p_book_id AND active = TRUE) THEN
+        RAISE EXCEPTION 'You already have an active reservation for this book.';
+    END IF;
+
+    -- Devolver un error si no hay copias disponibles
+    IF NOT copy_taken THEN
+        RAISE EXCEPTION 'No available copies of this book.';
+    END IF;
+
+    -- Insertar en la tabla de reservas y devolver la reserva creada
+    RETURN QUERY
+    INSERT INTO book_reservations (user_id, book_id, reservation_date, active)
+    VALUES (p_user_id, p_book_id, CURRENT_TIMESTAMP, TRUE)
+    RETURNING id, user_id, book_id, reservation_date, active;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Función para crear un préstamo y devolver el préstamo creado
+CREATE OR REPLACE FUNCTION create_loan(p_user_id INTEGER, p_book_id INTEGER) RETURNS SETOF loans AS $$
+BEGIN
+    -- Disminuir el número de copias disponibles; la fila del libro queda bloqueada
+    -- hasta el final de la transacción, lo que serializa los préstamos del mismo libro
+    UPDATE books
+    SET copies_available = copies_available - 1
+    WHERE id = p_book_id AND copies_available > 0;
+
+    -- Devolver un error si no hay copias disponibles (o el libro no existe)
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'No copies available for this book.';
+    END IF;
+
+    -- Verificar que el usuario no tenga ya un préstamo activo del libro
+    IF EXISTS (SELECT 1 FROM loans
+               WHERE book_id = p_book_id AND user_id = p_user_id AND returned = FALSE) THEN
+        RAISE EXCEPTION 'You already have an active loan for this book.';
+    END IF;
+
+    -- Insertar el préstamo y devolverlo
+    RETURN QUERY
+    INSERT INTO loans (user_id, book_id)
+    VALUES (p_user_id, p_book_id)
+    RETURNING id, user_id, book_id, loan_date, return_date, returned;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Función para marcar un préstamo como devuelto y devolver el préstamo actualizado
+CREATE OR REPLACE FUNCTION return_loan(p_loan_id INTEGER) RETURNS SETOF loans AS $$
+DECLARE
+    v_loan loans;
+BEGIN
+    -- Marcar el préstamo como devuelto; la condición returned = FALSE evita que
+    -- dos devoluciones simultáneas sumen dos copias
+    UPDATE loans
+    SET returned = TRUE, return_date = CURRENT_TIMESTAMP
+    WHERE id = p_loan_id AND returned = FALSE
+    RETURNING * INTO v_loan;
+
+    IF NOT FOUND THEN
+        IF EXISTS (SELECT 1 FROM loans WHERE id = p_loan_id) THEN
+            RAISE EXCEPTION 'Este préstamo ya ha sido devuelto.';
+        END IF;
+        RAISE EXCEPTION 'Préstamo no encontrado' USING ERRCODE = 'no_data_found';
+    END IF;
+
+    -- Incrementar el número de copias disponibles del libro
+    UPDATE books
+    SET copies_available = copies_available + 1
+    WHERE id = v_loan.book_id;
+
+    RETURN NEXT v_loan;
+END;
+$$ LANGUAGE plpgsql;
+
 -- Función para obtener las multas de un usuario
 CREATE OR REPLACE FUNCTION get_user_fines(p_user_id INTEGER) RETURNS SETOF fines AS $$
 BEGIN
@@ -21,6 +21,9 @@ CREATE TABLE users (
 );
 -- Índice para mejorar las consultas basadas en role_id
 CREATE INDEX idx_users_role_id ON users(role_id);
+-- Índice trigram para las búsquedas parciales por username (ILIKE '%...%')
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX idx_users_username_trgm ON users USING gin (username gin_trgm_ops);
 
 -- Tabla de Categorías (Normalizada)
 CREATE TABLE categories (
@@ -96,9 +99,14 @@ CREATE INDEX idx_reservations_book_id ON book_reservations(book_id);
 
 -- Índice compuesto para mejorar las consultas por usuario y libro en préstamos
 CREATE INDEX idx_loans_user_book ON loans(user_id, book_id);
+-- Índice parcial para buscar el préstamo activo de un usuario sobre un libro (create_loan)
+CREATE INDEX idx_loans_active_book_user ON loans(book_id, user_id) WHERE returned = FALSE;
 
 -- Índice compuesto para mejorar las consultas por usuario y estado en reservas
 CREATE INDEX idx_reservations_user_active ON book_reservations(user_id, active);
+-- Índice de cobertura para las reservas activas de un usuario (permite index-only scans)
+CREATE INDEX idx_reservations_user_active_covering ON book_reservations(user_id)
+  INCLUDE (id, book_id, reservation_date, active) WHERE active = TRUE;
 
 -- ==========================
 --  TABLA DE MULTAS
@@ -117,11 +125,8 @@ CREATE TABLE fines (
   FOREIGN KEY (loan_id) REFERENCES loans(id)
 );
 -- Índices para optimizar las consultas por usuario y estado de pago
-CREATE INDEX idx_fines_user_id ON fines(user_id);
+-- (por usuario ya ordenadas de la más reciente a la más antigua, como las pide get_user_fines)
+CREATE INDEX idx_fines_user_date ON fines(user_id, fine_date DESC);
 CREATE INDEX idx_fines_paid ON fines(paid);
-
-CREATE TABLE invalidated_tokens (
-    id SERIAL PRIMARY KEY,
-    token TEXT NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+-- Un préstamo tiene como máximo una multa pendiente de pago (destino del UPSERT de multas por retraso)
+CREATE UNIQUE INDEX idx_fines_unpaid_loan ON fines(loan_id) WHERE paid = FALSE;